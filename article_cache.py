@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Кэш статей на диске (SQLite)
+Ответы NewsAPI сохраняются по запросам вместе со временем загрузки и переживают перезапуск бота,
+отметки последней загруженной статьи по темам позволяют запрашивать только новые статьи,
+состояние квоты API сохраняется, чтобы перезапуск не начинал новый дневной бюджет
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ArticleCache:
+    """Статьи по запросам в SQLite с ограничением по размеру и возрасту"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queries (
+            key TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            articles TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_queries_fetched_at ON queries(fetched_at);
+        CREATE TABLE IF NOT EXISTS topic_marks (
+            key TEXT PRIMARY KEY,
+            high_water TEXT NOT NULL,
+            articles TEXT NOT NULL,
+            updated_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS quota (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_file: str = 'article_cache.db', max_entries: int = 2000,
+                 max_age: float = 7 * 86400):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Обращения к кэшу выполняются из потоков asyncio.to_thread
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._conn.commit()
+
+    def _migrate(self) -> None:
+        """Добавляет колонки, которых нет в базах прежних версий"""
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(topic_marks)')}
+        if 'updated_at' not in columns:
+            # Старые отметки получают время 0 и удаляются при ближайшей очистке
+            self._conn.execute('ALTER TABLE topic_marks ADD COLUMN updated_at REAL NOT NULL DEFAULT 0')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_topic_marks_updated_at ON topic_marks(updated_at)'
+        )
+
+    @staticmethod
+    def _serialize_key(key: Hashable) -> str:
+        """Ключ запроса в виде строки"""
+        return json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+
+    def get(self, key: Hashable) -> Optional[Tuple[float, List[Dict]]]:
+        """Возвращает (возраст в секундах, статьи) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT fetched_at, articles FROM queries WHERE key = ?',
+                (self._serialize_key(key),)
+            ).fetchone()
+        if row is None:
+            return None
+        fetched_at, articles = row
+        return time.time() - fetched_at, json.loads(articles)
+
+    def put(self, key: Hashable, articles: List[Dict]) -> None:
+        """Сохраняет статьи по запросу"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO queries (key, fetched_at, articles) VALUES (?, ?, ?)',
+                (self._serialize_key(key), time.time(), json.dumps(articles, ensure_ascii=False))
+            )
+
+    def get_topic_mark(self, key: Hashable) -> Optional[Tuple[str, List[Dict]]]:
+        """Возвращает (publishedAt самой новой статьи, накопленные статьи) по теме"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT high_water, articles FROM topic_marks WHERE key = ?',
+                (self._serialize_key(key),)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put_topic_mark(self, key: Hashable, high_water: str, articles: List[Dict]) -> None:
+        """Сохраняет отметку и накопленные статьи по теме"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO topic_marks (key, high_water, articles, updated_at) VALUES (?, ?, ?, ?)',
+                (self._serialize_key(key), high_water, json.dumps(articles, ensure_ascii=False), time.time())
+            )
+
+    def get_quota(self, name: str) -> Optional[Dict]:
+        """Возвращает сохраненное состояние квоты"""
+        with self._lock:
+            row = self._conn.execute('SELECT state FROM quota WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_quota(self, name: str, state: Dict) -> None:
+        """Сохраняет состояние квоты"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO quota (name, state) VALUES (?, ?)',
+                (name, json.dumps(state))
+            )
+
+    def prune(self) -> int:
+        """Удаляет устаревшие записи и самые старые записи сверх лимита (запросы и отметки тем)"""
+        removed = 0
+        with self._lock, self._conn:
+            for table, column in (('queries', 'fetched_at'), ('topic_marks', 'updated_at')):
+                removed += self._conn.execute(
+                    f'DELETE FROM {table} WHERE {column} < ?',
+                    (time.time() - self.max_age,)
+                ).rowcount
+                removed += self._conn.execute(
+                    f'DELETE FROM {table} WHERE key IN ('
+                    f'  SELECT key FROM {table} ORDER BY {column} DESC LIMIT -1 OFFSET ?'
+                    ')',
+                    (self.max_entries,)
+                ).rowcount
+        return removed
+
+    def vacuum(self) -> int:
+        """Очищает кэш по лимитам и сжимает файл базы"""
+        removed = self.prune()
+        with self._lock:
+            self._conn.execute('VACUUM')
+        logger.info(f"Кэш статей очищен: удалено записей {removed}")
+        return removed
+
+    def close(self) -> None:
+        """Закрывает соединение с базой"""
+        with self._lock:
+            self._conn.close()
@@ -5,15 +5,26 @@ Telegram News & Weather Bot
 """
 
 import os
-import json
 import logging
 import asyncio
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import requests
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 from dotenv import load_dotenv
+from storage import create_user_store, WriteBehindWriter
+from upstream import QuotaExceededError, UpstreamClient, UpstreamError
+from caching import SingleFlight, TTLCache
+from article_cache import ArticleCache
+from delivery import DeliveryEngine, DeliveryJob
+from dedup import ArticleDeduplicator, canonicalize_url
+from messages import BlockRenderer, MessageBuilder, TOPIC_SEPARATOR, escape
+from matching import KeywordMatcher, SubscriptionIndex, compile_keywords, normalize_article_text, normalize_text
+from news_sources import NewsApiSource, RssSource, merge_articles, pack_topic_queries, plan_news_query
+from ranking import ArticleRanker, parse_source_weights
+from scheduler import DigestScheduler, get_timezone, parse_digest_time
+from ratelimit import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, QuotaManager
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -28,47 +39,259 @@ logger = logging.getLogger(__name__)
 class NewsBot:
     """Основной класс для работы с новостным ботом"""
     
+    # Сколько новостей по одной теме показывать в сообщении
+    ARTICLES_PER_TOPIC = 5
+    
     def __init__(self):
-        self.data_file = 'news_data.json'
+        self.store = create_user_store()
         self.users_data = self.load_data()
+        # Изменения сбрасываются на диск фоновой задачей не чаще раза в интервал
+        self.writer = WriteBehindWriter(
+            self.store,
+            self.users_data,
+            flush_interval_ms=int(os.getenv('SAVE_INTERVAL_MS', '500'))
+        )
         self.news_api_key = os.getenv('NEWS_API_KEY')
         self.news_api_url = 'https://newsapi.org/v2/everything'
+        self.news_language = os.getenv('NEWS_LANGUAGE', 'ru')
+        # Искать ключевые слова только целыми словами (по умолчанию - подстрокой, как раньше)
+        self.keyword_whole_words = os.getenv('KEYWORD_WHOLE_WORDS', 'false').lower() == 'true'
+        # Сравнивать ключевые слова и текст по основам слов (русский и английский)
+        self.keyword_stemming = os.getenv('KEYWORD_STEMMING', 'true').lower() == 'true'
+        # Насколько могут различаться SimHash отпечатки почти одинаковых статей (в битах)
+        self.dedup_distance = int(os.getenv('DEDUP_MAX_DISTANCE', '16'))
+        # Ранжирование статей темы: BM25 по словам темы, затухание по возрасту, веса источников
+        self.ranker = ArticleRanker(
+            half_life_hours=float(os.getenv('RANKING_HALF_LIFE_HOURS', '24')),
+            recency_weight=float(os.getenv('RANKING_RECENCY_WEIGHT', '0.3')),
+            source_weights=parse_source_weights(os.getenv('RANKING_SOURCE_WEIGHTS', '')),
+            stem=self.keyword_stemming
+        )
+        # Сколько тем загружается параллельно при рассылке дайджеста
+        self.digest_fetch_concurrency = int(os.getenv('DIGEST_FETCH_CONCURRENCY', '5'))
+        # Сколько тем объединять в один запрос к NewsAPI при рассылке (1 - без объединения)
+        self.digest_batch_size = int(os.getenv('DIGEST_BATCH_TOPICS', '1'))
+        self.batch_requests_saved = 0
+        # Рассылка дайджестов: общий лимит Telegram ~30 сообщений в секунду и 1 сообщение в секунду в чат
+        self.delivery = DeliveryEngine(
+            rate=float(os.getenv('DELIVERY_RATE', '30')),
+            chat_rate=float(os.getenv('DELIVERY_CHAT_RATE', '1')),
+            concurrency=int(os.getenv('DELIVERY_CONCURRENCY', '30'))
+        )
+        # Сколько получателей было в последнем прогоне дайджеста и сколько разных текстов собрано
+        self.digest_memo_stats = {'users': 0, 'signatures': 0}
         # API для погоды Open-Meteo (бесплатный)
         self.weather_api_url = 'https://api.open-meteo.com/v1/forecast'
         self.geocoding_api_url = 'https://geocoding-api.open-meteo.com/v1/search'
+        # Общий пул соединений для всех внешних API
+        self.http = UpstreamClient(
+            timeout=float(os.getenv('UPSTREAM_TIMEOUT', '10')),
+            per_host_limit=int(os.getenv('UPSTREAM_PER_HOST_LIMIT', '10')),
+            breaker_failures=int(os.getenv('UPSTREAM_BREAKER_FAILURES', '5')),
+            breaker_reset=float(os.getenv('UPSTREAM_BREAKER_RESET', '30')),
+            hedge_after=float(os.getenv('UPSTREAM_HEDGE_AFTER', '0')),
+            hedge_hosts=[
+                host.strip() for host in
+                os.getenv('UPSTREAM_HEDGE_HOSTS', 'api.open-meteo.com,geocoding-api.open-meteo.com').split(',')
+                if host.strip()
+            ]
+        )
+        # Кэш ответов NewsAPI: одинаковые запросы в пределах TTL не расходуют квоту
+        self.news_cache = TTLCache(
+            maxsize=int(os.getenv('NEWS_CACHE_SIZE', '512')),
+            ttl=float(os.getenv('NEWS_CACHE_TTL', '600')),
+            stale_ttl=float(os.getenv('NEWS_CACHE_STALE_TTL', '0')),
+            name='news_cache'
+        )
+        # Кэш статей на диске: переживает перезапуск и засыпание сервиса
+        article_cache_file = os.getenv('ARTICLE_CACHE_FILE', 'article_cache.db')
+        self.article_cache = ArticleCache(
+            article_cache_file,
+            max_entries=int(os.getenv('ARTICLE_CACHE_MAX_ENTRIES', '2000')),
+            max_age=float(os.getenv('ARTICLE_CACHE_MAX_AGE', str(7 * 86400)))
+        ) if article_cache_file else None
+        # Отметки последней загруженной статьи по темам, если кэш на диске отключен (с теми же лимитами)
+        self.topic_marks = TTLCache(
+            maxsize=int(os.getenv('ARTICLE_CACHE_MAX_ENTRIES', '2000')),
+            ttl=float(os.getenv('ARTICLE_CACHE_MAX_AGE', str(7 * 86400))),
+            name='topic_marks'
+        )
+        # За сколько секунд хранить накопленные статьи темы для инкрементальной загрузки
+        self.incremental_window = float(os.getenv('INCREMENTAL_WINDOW', str(2 * 86400)))
+        # На сколько секунд раньше отметки запрашивать статьи: NewsAPI индексирует часть статей с опозданием
+        self.incremental_lookback = float(os.getenv('INCREMENTAL_LOOKBACK', '3600'))
+        # Результаты прогрева перед дайджестом: ключ темы -> (время загрузки, статьи)
+        self.prewarmed: Dict[Tuple, Tuple[datetime, List[Dict]]] = {}
+        self.prewarm_top_topics = int(os.getenv('PREWARM_TOP_TOPICS', '0'))
+        self.prewarm_max_age = float(os.getenv('PREWARM_MAX_AGE', '3600'))
+        # Дайджест отправляется каждому пользователю в его время; пользователи без своего времени
+        # распределяются по окну DIGEST_SPREAD_MINUTES после DIGEST_TIME
+        self.digest_scheduler = DigestScheduler(
+            default_time=os.getenv('DIGEST_TIME', '09:00'),
+            default_timezone=os.getenv('DIGEST_TIMEZONE') or None,
+            spread_minutes=int(os.getenv('DIGEST_SPREAD_MINUTES', '0'))
+        )
+        # Размер пачки пользователей: темы пачки загружаются и рассылаются вместе
+        self.digest_batch_users = int(os.getenv('DIGEST_BATCH_USERS', '500'))
+        self.prewarm_window = int(os.getenv('PREWARM_MINUTES', '10')) * 60
+        # Источники новостей: NewsAPI и RSS/Atom ленты из RSS_FEEDS (URL или пути к файлам через запятую)
+        self.news_sources = []
+        if self.news_api_key:
+            self.news_sources.append(NewsApiSource(self.get_news, self.keyword_whole_words, self.keyword_stemming))
+        rss_feeds = [feed.strip() for feed in os.getenv('RSS_FEEDS', '').split(',') if feed.strip()]
+        if rss_feeds:
+            self.news_sources.append(RssSource(rss_feeds, self.http, stem=self.keyword_stemming))
+        # Последняя полученная погода по городам: ответ в пределах TTL и запасной вариант при сбое API
+        self.weather_cache = TTLCache(
+            maxsize=int(os.getenv('WEATHER_CACHE_SIZE', '256')),
+            ttl=float(os.getenv('WEATHER_CACHE_TTL', '600')),
+            name='weather_cache'
+        )
+        # Готовые HTML блоки статей: блок собирается один раз для всех пользователей и тем
+        self.block_renderer = BlockRenderer(
+            maxsize=int(os.getenv('RENDER_CACHE_SIZE', '2048')),
+            ttl=float(os.getenv('RENDER_CACHE_TTL', '21600'))
+        )
+        # Одновременные одинаковые запросы к внешним API объединяются в один
+        self.news_flight = SingleFlight('news')
+        self.geocoding_flight = SingleFlight('geocoding')
+        self.weather_flight = SingleFlight('weather')
+        # Бюджет запросов NewsAPI (бесплатный тариф: 100 запросов в сутки)
+        self.news_quota = QuotaManager(
+            daily_limit=int(os.getenv('NEWSAPI_DAILY_LIMIT', '100')),
+            per_second=float(os.getenv('NEWSAPI_RATE_PER_SEC', '1')),
+            background_reserve=int(os.getenv('NEWSAPI_BACKGROUND_RESERVE', '20'))
+        )
+        # Израсходованная квота хранится в кэше на диске: перезапуск не обнуляет дневной бюджет
+        if self.article_cache is not None:
+            try:
+                quota_state = self.article_cache.get_quota('newsapi')
+                if quota_state:
+                    self.news_quota.restore(quota_state)
+                    logger.info(f"Восстановлена квота NewsAPI: осталось {self.news_quota.remaining()}")
+            except Exception as e:
+                logger.error(f"Ошибка чтения состояния квоты NewsAPI: {e}")
         
     def load_data(self) -> Dict:
-        """Загружает данные пользователей из JSON файла"""
+        """Загружает данные пользователей из хранилища"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    logger.info(f"Загружены данные для {len(data)} пользователей")
-                    return data
-            logger.info("Файл данных не найден, создаем новый")
-            return {}
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON: {e}")
-            # Создаем резервную копию поврежденного файла
-            if os.path.exists(self.data_file):
-                backup_file = f"{self.data_file}.backup"
-                os.rename(self.data_file, backup_file)
-                logger.info(f"Создана резервная копия: {backup_file}")
-            return {}
+            return self.store.load()
         except Exception as e:
             logger.error(f"Ошибка при загрузке данных: {e}")
             return {}
     
-    def save_data(self) -> None:
-        """Сохраняет данные пользователей в JSON файл"""
+    def save_user(self, user_id: int) -> None:
+        """Помечает для сохранения данные одного пользователя"""
+        self.writer.mark_dirty(user_id)
+    
+    def get_stats(self) -> Dict[str, Dict]:
+        """Счетчики кэшей и объединенных запросов"""
+        return {
+            'news_cache': self.news_cache.stats(),
+            'news_flight': self.news_flight.stats(),
+            'news_quota': self.news_quota.stats(),
+            'digest_batching': {'requests_saved': self.batch_requests_saved},
+            'digest_memo': self.digest_memo_stats,
+            'delivery': self.delivery.stats(),
+            'geocoding_flight': self.geocoding_flight.stats(),
+            'weather_flight': self.weather_flight.stats(),
+            'weather_cache': self.weather_cache.stats(),
+            'rendered_blocks': self.block_renderer.stats(),
+            'upstream': self.http.stats(),
+            **{f'{source.name}_source': source.stats() for source in self.news_sources}
+        }
+    
+    async def vacuum_article_cache(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Периодическая очистка и сжатие кэша статей на диске"""
+        if self.article_cache is None:
+            return
+        try:
+            await asyncio.to_thread(self.article_cache.vacuum)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке кэша статей: {e}")
+    
+    async def start(self) -> None:
+        """Запускает фоновые задачи бота и планирует дайджесты пользователей"""
+        await self.writer.start()
+        for user_id in list(self.users_data):
+            self.schedule_user_digest(user_id)
+        logger.info(f"Запланировано дайджестов: {len(self.digest_scheduler)}")
+    
+    async def shutdown(self) -> None:
+        """Останавливает фоновые задачи и сохраняет несохраненные данные"""
+        await self.writer.stop()
+        self.store.close()
+        if self.article_cache is not None:
+            self.article_cache.close()
+        await self.http.aclose()
+    
+    @staticmethod
+    def _news_cache_key(query: str, language: str, params: Dict) -> tuple:
+        """Нормализованный ключ кэша для запроса новостей"""
+        normalized_query = ' '.join(query.lower().split())
+        return (normalized_query, language, tuple(sorted(params.items())))
+    
+    async def _save_news_quota(self) -> None:
+        """Сохраняет состояние квоты NewsAPI в кэш на диске"""
+        if self.article_cache is None:
+            return
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.users_data, f, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(self.article_cache.put_quota, 'newsapi', self.news_quota.state())
         except Exception as e:
-            logger.error(f"Ошибка при сохранении данных: {e}")
+            logger.error(f"Ошибка записи состояния квоты NewsAPI: {e}")
     
-    def get_news(self, query: str, language: str = 'ru') -> List[Dict]:
-        """Получает новости по запросу из NewsAPI"""
+    async def _fetch_news(self, params: Dict, priority: str = PRIORITY_INTERACTIVE) -> List[Dict]:
+        """Запрашивает новости из NewsAPI в пределах квоты (ошибки пробрасываются)"""
+        if not await self.news_quota.acquire(priority):
+            raise QuotaExceededError(f"Квота NewsAPI исчерпана (осталось {self.news_quota.remaining()})")
+        # Запрос учитывается до отправки, чтобы сбой после него не вернул потраченную квоту
+        await self._save_news_quota()
+        try:
+            data = await self.http.get_json(self.news_api_url, params={**params, 'apiKey': self.news_api_key})
+        except UpstreamError as e:
+            if e.status_code == 429:
+                self.news_quota.on_rate_limited(e.retry_after)
+                await self._save_news_quota()
+                # Ответ 429 - то же исчерпание квоты: вызывающий сообщит пользователю о лимите
+                raise QuotaExceededError(str(e), status_code=429, retry_after=e.retry_after) from e
+            raise
+        return data.get('articles', [])
+    
+    async def _load_news(self, key: tuple, params: Dict, priority: str) -> List[Dict]:
+        """Загружает новости из кэша на диске или из NewsAPI с сохранением на диск"""
+        cached = None
+        if self.article_cache is not None:
+            try:
+                cached = await asyncio.to_thread(self.article_cache.get, key)
+            except Exception as e:
+                logger.error(f"Ошибка чтения кэша статей: {e}")
+            if cached is not None and cached[0] <= self.news_cache.ttl:
+                return cached[1]
+        
+        try:
+            articles = await self._fetch_news(params, priority)
+        except UpstreamError as e:
+            if cached is None:
+                raise
+            logger.warning(f"{e}; используем статьи из кэша на диске возрастом {cached[0]:.0f} сек")
+            return cached[1]
+        
+        if self.article_cache is not None:
+            try:
+                await asyncio.to_thread(self.article_cache.put, key, articles)
+            except Exception as e:
+                logger.error(f"Ошибка записи кэша статей: {e}")
+        return articles
+    
+    async def get_news(self, query: str, language: Optional[str] = None,
+                       priority: str = PRIORITY_INTERACTIVE,
+                       extra_params: Optional[Dict] = None) -> List[Dict]:
+        """Получает новости по запросу из NewsAPI (с кэшированием и учетом квоты)
+
+        Исчерпание квоты (QuotaExceededError) пробрасывается, если в кэше нет ответа на запрос,
+        чтобы пользователь получил сообщение о лимите, а не "новостей не найдено".
+        """
+        language = language or self.news_language
         try:
             if not self.news_api_key:
                 logger.warning("API ключ для новостей не настроен")
@@ -78,70 +301,108 @@ class NewsBot:
                 'q': query,
                 'language': language,
                 'sortBy': 'publishedAt',
-                'pageSize': 10,
-                'apiKey': self.news_api_key
+                'pageSize': 10
             }
+            if extra_params:
+                params.update(extra_params)
             
-            response = requests.get(self.news_api_url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            return data.get('articles', [])
+            key = self._news_cache_key(query, language, params)
+            try:
+                return await self.news_cache.get_or_fetch(
+                    key,
+                    lambda: self.news_flight.do(key, lambda: self._load_news(key, params, priority))
+                )
+            except UpstreamError as e:
+                # При исчерпанной квоте или ошибке API отдаем последний известный ответ
+                entry = self.news_cache.peek(key)
+                if entry is None:
+                    raise
+                logger.warning(f"{e}; используем сохраненные новости возрастом {entry.age:.0f} сек")
+                return entry.value
             
-        except requests.exceptions.RequestException as e:
+        except QuotaExceededError as e:
+            logger.warning(f"Новости по '{query}' не загружены: {e}")
+            raise
+        except UpstreamError as e:
             logger.error(f"Ошибка при получении новостей: {e}")
             return []
         except Exception as e:
             logger.error(f"Неожиданная ошибка при получении новостей: {e}")
             return []
     
-    def filter_news_by_keywords(self, articles: List[Dict], keywords: List[str]) -> List[Dict]:
+    async def fetch_articles(self, query: str, language: Optional[str] = None,
+                             priority: str = PRIORITY_INTERACTIVE,
+                             extra_params: Optional[Dict] = None,
+                             keywords: Optional[List[str]] = None,
+                             sources: Optional[List] = None) -> List[Dict]:
+        """Параллельно запрашивает источники новостей (по умолчанию все) и объединяет результаты
+
+        Если ни один источник не ответил из-за исчерпания квоты, пробрасывает QuotaExceededError.
+        """
+        language = language or self.news_language
+        sources = self.news_sources if sources is None else sources
+        if not sources:
+            logger.warning("Источники новостей не настроены (нужен NEWS_API_KEY или RSS_FEEDS)")
+            return []
+        
+        results = await asyncio.gather(
+            *(source.fetch(query, language, priority, extra_params, keywords) for source in sources),
+            return_exceptions=True
+        )
+        article_lists = []
+        quota_error = None
+        for source, result in zip(sources, results):
+            if isinstance(result, QuotaExceededError):
+                quota_error = result
+                continue
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка источника {source.name}: {result}")
+                continue
+            article_lists.append(result)
+        
+        if not article_lists and quota_error is not None:
+            raise quota_error
+        if len(article_lists) == 1:
+            return article_lists[0]
+        return merge_articles(*article_lists)
+    
+    def get_topic_matcher(self, record: Dict) -> KeywordMatcher:
+        """Автомат ключевых слов темы (кэшируется в записи темы, пересобирается при изменении слов)"""
+        keywords = tuple(record.get('keywords') or ())
+        matcher = record.get('_matcher')
+        if matcher is None or matcher.source != keywords:
+            matcher = compile_keywords(keywords, self.keyword_whole_words, self.keyword_stemming)
+            # Поля с префиксом _ не сохраняются хранилищем
+            record['_matcher'] = matcher
+        return matcher
+    
+    def filter_news_by_keywords(self, articles: List[Dict], keywords: List[str],
+                                matcher: Optional[KeywordMatcher] = None) -> List[Dict]:
         """Фильтрует новости по ключевым словам"""
         if not keywords:
             return articles
         
-        filtered_articles = []
-        for article in articles:
-            title = article.get('title', '').lower()
-            description = article.get('description', '').lower()
-            content = f"{title} {description}"
-            
-            if any(keyword.lower() in content for keyword in keywords):
-                filtered_articles.append(article)
-        
-        return filtered_articles
+        matcher = matcher or compile_keywords(tuple(keywords), self.keyword_whole_words, self.keyword_stemming)
+        return [
+            article for article in articles
+            if matcher.matches(f"{article.get('title') or ''} {article.get('description') or ''}")
+        ]
     
-    def format_news_message(self, articles: List[Dict], topic: str) -> str:
-        """Форматирует новости для отправки в Telegram"""
-        if not articles:
-            return f"📰 По теме '{topic}' новостей не найдено."
-        
-        message = f"📰 <b>Новости по теме: {topic}</b>\n\n"
-        
-        for i, article in enumerate(articles[:5], 1):  # Показываем только первые 5 новостей
-            title = article.get('title', 'Без заголовка')
-            description = article.get('description', '')
-            url = article.get('url', '')
-            published_at = article.get('publishedAt', '')
-            
-            # Форматируем дату
-            try:
-                if published_at:
-                    date_obj = datetime.fromisoformat(published_at.replace('Z', '+00:00'))
-                    formatted_date = date_obj.strftime('%d.%m.%Y %H:%M')
-                else:
-                    formatted_date = 'Дата неизвестна'
-            except:
-                formatted_date = 'Дата неизвестна'
-            
-            message += f"{i}. <b>{title}</b>\n"
-            if description:
-                message += f"   {description[:200]}{'...' if len(description) > 200 else ''}\n"
-            if url:
-                message += f"   🔗 <a href='{url}'>Читать далее</a>\n"
-            message += f"   📅 {formatted_date}\n\n"
-        
-        return message
+    def rank_topic_articles(self, articles: List[Dict], topic: str, keywords: Optional[List[str]] = None,
+                            language: Optional[str] = None) -> List[Dict]:
+        """Сортирует статьи одной темы по релевантности"""
+        key = self._topic_key(topic, language or self.news_language, keywords)
+        return self.ranker.rank({key: articles})[key]
+    
+    def take_unique_articles(self, articles: List[Dict], deduplicator: ArticleDeduplicator) -> List[Dict]:
+        """Первые статьи для сообщения без повторов (повтором считается и статья из предыдущих тем)"""
+        unique = []
+        for article in articles:
+            if len(unique) >= self.ARTICLES_PER_TOPIC:
+                break
+            if not deduplicator.is_duplicate(article):
+                unique.append(article)
+        return unique
     
     def add_user_topic(self, user_id: int, topic: str, keywords: List[str] = None) -> None:
         """Добавляет тему для пользователя"""
@@ -162,7 +423,8 @@ class NewsBot:
             'added_at': datetime.now().isoformat()
         })
         
-        self.save_data()
+        self.save_user(user_id)
+        self.schedule_user_digest(user_id)
     
     def remove_user_topic(self, user_id: int, topic: str) -> bool:
         """Удаляет тему у пользователя"""
@@ -172,7 +434,8 @@ class NewsBot:
         topics = self.users_data[user_id]['topics']
         self.users_data[user_id]['topics'] = [t for t in topics if t['name'] != topic]
         
-        self.save_data()
+        self.save_user(user_id)
+        self.schedule_user_digest(user_id)
         return True
     
     def get_user_topics(self, user_id: int) -> List[Dict]:
@@ -192,77 +455,112 @@ class NewsBot:
             }
         
         self.users_data[user_id]['daily_digest'] = not self.users_data[user_id]['daily_digest']
-        self.save_data()
+        self.save_user(user_id)
+        self.schedule_user_digest(user_id)
         return self.users_data[user_id]['daily_digest']
     
-    def get_location_coordinates(self, location: str) -> Optional[Dict]:
-        """Получает координаты местоположения через Geocoding API"""
-        try:
-            params = {
-                'name': location,
-                'count': 1,
-                'language': 'ru'
+    def set_digest_time(self, user_id: int, digest_time: str, timezone_name: Optional[str] = None,
+                        clear_timezone: bool = False) -> Optional[float]:
+        """Сохраняет время и часовой пояс дайджеста пользователя
+
+        Возвращает время ближайшей отправки или None, если дайджест не запланирован
+        (дайджесты выключены или у пользователя нет тем).
+        """
+        if user_id not in self.users_data:
+            self.users_data[user_id] = {
+                'topics': [],
+                'keywords': [],
+                'daily_digest': True,
+                'last_digest': None
             }
-            
-            response = requests.get(self.geocoding_api_url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            if data.get('results'):
-                result = data['results'][0]
-                return {
-                    'name': result.get('name', location),
-                    'latitude': result.get('latitude'),
-                    'longitude': result.get('longitude'),
-                    'country': result.get('country', ''),
-                    'admin1': result.get('admin1', '')
-                }
-            return None
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка при получении координат: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при геокодировании: {e}")
+        
+        user_data = self.users_data[user_id]
+        user_data['digest_time'] = digest_time
+        if clear_timezone:
+            user_data.pop('timezone', None)
+        elif timezone_name:
+            user_data['timezone'] = timezone_name
+        self.save_user(user_id)
+        self.schedule_user_digest(user_id)
+        return self.digest_scheduler.scheduled_at(user_id)
+    
+    def schedule_user_digest(self, user_id: int, after: Optional[float] = None) -> None:
+        """Планирует ближайший дайджест пользователя (или снимает с расписания, если он не нужен)"""
+        user_data = self.users_data.get(user_id)
+        if not user_data or not user_data.get('daily_digest', False) or not user_data.get('topics'):
+            self.digest_scheduler.cancel(user_id)
+            return
+        self.digest_scheduler.schedule(user_id, user_data.get('digest_time'), user_data.get('timezone'), after)
+    
+    async def _fetch_coordinates(self, location: str) -> Optional[Dict]:
+        """Запрашивает координаты через Geocoding API (ошибки пробрасываются)"""
+        params = {
+            'name': location,
+            'count': 1,
+            'language': 'ru'
+        }
+        
+        key = ' '.join(location.lower().split())
+        data = await self.geocoding_flight.do(
+            key,
+            lambda: self.http.get_json(self.geocoding_api_url, params=params)
+        )
+        if data.get('results'):
+            result = data['results'][0]
+            return {
+                'name': result.get('name', location),
+                'latitude': result.get('latitude'),
+                'longitude': result.get('longitude'),
+                'country': result.get('country', ''),
+                'admin1': result.get('admin1', '')
+            }
+        return None
+    
+    async def _fetch_weather(self, location: str) -> Optional[Dict]:
+        """Запрашивает координаты и погоду через Open-Meteo API (ошибки пробрасываются)"""
+        # Сначала получаем координаты
+        coords = await self._fetch_coordinates(location)
+        if not coords:
             return None
+        
+        # Получаем погоду по координатам на 2 дня (сегодня и завтра)
+        params = {
+            'latitude': coords['latitude'],
+            'longitude': coords['longitude'],
+            'current': 'temperature_2m,relative_humidity_2m,precipitation,weather_code,wind_speed_10m',
+            'hourly': 'temperature_2m,precipitation,weather_code',
+            'daily': 'weather_code,temperature_2m_max,temperature_2m_min,precipitation_sum,windspeed_10m_max',
+            'timezone': 'auto',
+            'forecast_days': 2  # Получаем данные на сегодня и завтра
+        }
+        
+        key = (coords['latitude'], coords['longitude'])
+        weather_data = await self.weather_flight.do(
+            key,
+            lambda: self.http.get_json(self.weather_api_url, params=params)
+        )
+        
+        # Форматируем данные для удобства
+        return {
+            'location': coords['name'],
+            'country': coords.get('country', ''),
+            'admin1': coords.get('admin1', ''),
+            'current': weather_data.get('current', {}),
+            'hourly': weather_data.get('hourly', {}),
+            'daily': weather_data.get('daily', {})
+        }
     
-    def get_weather(self, location: str) -> Optional[Dict]:
+    async def get_weather(self, location: str) -> Optional[Dict]:
         """Получает погоду для указанного местоположения через Open-Meteo API"""
+        key = ' '.join(location.lower().split())
         try:
-            # Сначала получаем координаты
-            coords = self.get_location_coordinates(location)
-            if not coords:
-                return None
-            
-            # Получаем погоду по координатам на 2 дня (сегодня и завтра)
-            params = {
-                'latitude': coords['latitude'],
-                'longitude': coords['longitude'],
-                'current': 'temperature_2m,relative_humidity_2m,precipitation,weather_code,wind_speed_10m',
-                'hourly': 'temperature_2m,precipitation,weather_code',
-                'daily': 'weather_code,temperature_2m_max,temperature_2m_min,precipitation_sum,windspeed_10m_max',
-                'timezone': 'auto',
-                'forecast_days': 2  # Получаем данные на сегодня и завтра
-            }
-            
-            response = requests.get(self.weather_api_url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            weather_data = response.json()
-            
-            # Форматируем данные для удобства
-            result = {
-                'location': coords['name'],
-                'country': coords.get('country', ''),
-                'admin1': coords.get('admin1', ''),
-                'current': weather_data.get('current', {}),
-                'hourly': weather_data.get('hourly', {}),
-                'daily': weather_data.get('daily', {})
-            }
-            
-            return result
-            
-        except requests.exceptions.RequestException as e:
+            return await self.weather_cache.get_or_fetch(key, lambda: self._fetch_weather(location))
+        except UpstreamError as e:
+            # При сбое или разомкнутом выключателе сразу отдаем последнюю известную погоду
+            entry = self.weather_cache.peek(key)
+            if entry is not None and entry.value:
+                logger.warning(f"{e}; используем погоду для '{location}' возрастом {entry.age:.0f} сек")
+                return entry.value
             logger.error(f"Ошибка при получении погоды: {e}")
             return None
         except Exception as e:
@@ -304,7 +602,7 @@ class NewsBot:
         daily_time = daily.get('time', [])
         
         # Формируем сообщение
-        message = f"🌤️ <b>Погода в {place_name}</b>\n\n"
+        message = f"🌤️ <b>Погода в {escape(place_name)}</b>\n\n"
         message += f"📅 <b>Сейчас:</b>\n"
         
         # Текущая погода
@@ -414,61 +712,446 @@ class NewsBot:
         }
         return descriptions.get(weather_code, "Неизвестная погода")
     
-    async def send_daily_digest(self, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Отправляет ежедневные дайджесты всем пользователям"""
-        logger.info("Начинаем отправку ежедневных дайджестов")
+    @staticmethod
+    def _topic_key(topic_name: str, language: str, keywords: Optional[List[str]] = None) -> Tuple:
+        """Нормализованный ключ темы (с ключевыми словами) для общей загрузки новостей"""
+        normalized_keywords = tuple(sorted({
+            ' '.join(keyword.lower().split()) for keyword in keywords or [] if keyword.strip()
+        }))
+        return (' '.join(topic_name.lower().split()), language, normalized_keywords)
+    
+    @staticmethod
+    def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+        """Разбирает дату ISO 8601; дата без часового пояса считается локальной"""
+        if not value:
+            return None
+        try:
+            date_obj = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        return date_obj if date_obj.tzinfo else date_obj.astimezone()
+    
+    async def _get_topic_mark(self, key: Tuple) -> Optional[Tuple[str, List[Dict]]]:
+        """Отметка темы: publishedAt самой новой статьи и накопленные статьи"""
+        if self.article_cache is None:
+            return self.topic_marks.get(key)
+        try:
+            return await asyncio.to_thread(self.article_cache.get_topic_mark, key)
+        except Exception as e:
+            logger.error(f"Ошибка чтения отметки темы {key}: {e}")
+            return None
+    
+    async def _put_topic_mark(self, key: Tuple, high_water: str, articles: List[Dict]) -> None:
+        """Сохраняет отметку темы"""
+        if self.article_cache is None:
+            self.topic_marks.set(key, (high_water, articles))
+            return
+        try:
+            await asyncio.to_thread(self.article_cache.put_topic_mark, key, high_water, articles)
+        except Exception as e:
+            logger.error(f"Ошибка записи отметки темы {key}: {e}")
+    
+    async def _update_topic_mark(self, key: Tuple, fresh_articles: List[Dict],
+                                 mark: Optional[Tuple[str, List[Dict]]]) -> List[Dict]:
+        """Объединяет новые статьи темы с накопленными и сохраняет отметку"""
+        # NewsAPI включает границу from, поэтому статьи объединяются без дублей по URL
+        known_articles = mark[1] if mark else []
+        merged = {}
+        for article in fresh_articles + known_articles:
+            merged.setdefault(canonicalize_url(article.get('url') or '') or id(article), article)
+        
+        # Оставляем статьи в пределах окна, самые новые первыми
+        border = datetime.now().astimezone() - timedelta(seconds=self.incremental_window)
+        articles = [
+            article for article in merged.values()
+            if (self._parse_timestamp(article.get('publishedAt')) or border) >= border
+        ]
+        articles.sort(key=lambda article: article.get('publishedAt') or '', reverse=True)
+        articles = articles[:100]
+        
+        if articles and articles[0].get('publishedAt'):
+            await self._put_topic_mark(key, articles[0]['publishedAt'], articles)
+        return articles
+    
+    def _mark_since(self, mark: Optional[Tuple[str, List[Dict]]]) -> Optional[str]:
+        """Граница from для темы: отметка минус запас на статьи, проиндексированные с опозданием"""
+        high_water = self._parse_timestamp(mark[0]) if mark else None
+        if high_water is None:
+            return None
+        since = high_water - timedelta(seconds=self.incremental_lookback)
+        return since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    
+    async def get_news_since(self, topic_name: str, language: str, keywords: Optional[List[str]] = None,
+                             priority: str = PRIORITY_BACKGROUND) -> List[Dict]:
+        """Запрашивает только статьи новее отметки темы и объединяет их с уже загруженными
+
+        Исчерпание квоты пробрасывается: тема считается не обновленной.
+        """
+        key = self._topic_key(topic_name, language, keywords)
+        mark = await self._get_topic_mark(key)
+        since = self._mark_since(mark)
+        fresh_articles = await self.fetch_articles(key[0], language, priority=priority,
+                                                   extra_params={'from': since} if since else None,
+                                                   keywords=list(key[2]))
+        return await self._update_topic_mark(key, fresh_articles, mark)
+    
+    def _article_matches_topic(self, article: Dict, key: Tuple) -> bool:
+        """Относится ли статья из пакетного запроса к теме (все слова темы и хотя бы одно ключевое слово)"""
+        content = normalize_article_text(
+            f"{article.get('title') or ''} {article.get('description') or ''}", self.keyword_stemming
+        )
+        if not all(word in content for word in normalize_text(key[0], self.keyword_stemming).split()):
+            return False
+        return not key[2] or bool(self.filter_news_by_keywords([article], list(key[2])))
+    
+    async def _fetch_topics_batched(self, topic_keys: List[Tuple]
+                                    ) -> Dict[Tuple, Tuple[Optional[datetime], List[Dict]]]:
+        """Загружает темы из NewsAPI объединенными OR-запросами и распределяет статьи по темам"""
+        marks = dict(zip(topic_keys, await asyncio.gather(*(self._get_topic_mark(key) for key in topic_keys))))
+        since = {key: self._mark_since(marks[key]) for key in topic_keys}
+        plans = {
+            key: plan_news_query(key[0], list(key[2]), whole_words=self.keyword_whole_words,
+                                 stem=self.keyword_stemming)
+            for key in topic_keys
+        }
+        batches = pack_topic_queries([(key, plans[key]['q']) for key in topic_keys],
+                                     max_topics=self.digest_batch_size)
+        semaphore = asyncio.Semaphore(self.digest_fetch_concurrency)
+        
+        async def fetch_batch(batch: List[Tuple], query: str
+                              ) -> Tuple[List[Tuple], Optional[datetime], bool, List[Dict]]:
+            """Загружает пакет; возвращает (темы, время загрузки, заполнена ли страница целиком, статьи)"""
+            if len(batch) == 1:
+                params = {k: v for k, v in plans[batch[0]].items() if k != 'q'}
+            else:
+                # Статьи пакета распределяются по темам по заголовку и описанию - там же ищет и NewsAPI
+                params = {'pageSize': min(100, 10 * len(batch)), 'searchIn': 'title,description'}
+            # Граница from - самая ранняя из отметок тем пакета (только если отметки есть у всех)
+            batch_since = [since[key] for key in batch]
+            if all(batch_since):
+                params['from'] = min(batch_since)
+            async with semaphore:
+                fetched_at = datetime.now()
+                try:
+                    articles = await self.get_news(query, batch[0][1], priority=PRIORITY_BACKGROUND,
+                                                   extra_params=params)
+                except QuotaExceededError as e:
+                    logger.warning(f"Пакет из {len(batch)} тем не обновлен: {e}")
+                    return batch, None, False, []
+            # Полная страница: статьи частой темы могли вытеснить статьи остальных тем пакета
+            saturated = len(batch) > 1 and len(articles) >= params.get('pageSize', 10)
+            return batch, fetched_at, saturated, articles
+        
+        async def fetch_single(key: Tuple) -> Tuple[Tuple, bool, List[Dict]]:
+            """Загружает одну тему отдельным запросом"""
+            params = {k: v for k, v in plans[key].items() if k != 'q'}
+            if since[key]:
+                params['from'] = since[key]
+            async with semaphore:
+                try:
+                    articles = await self.get_news(plans[key]['q'], key[1], priority=PRIORITY_BACKGROUND,
+                                                   extra_params=params)
+                except QuotaExceededError as e:
+                    logger.warning(f"Тема '{key[0]}' не дозагружена: {e}")
+                    return key, False, []
+            return key, True, articles
+        
+        results = await asyncio.gather(*(fetch_batch(batch, query) for batch, query in batches))
+        
+        fresh_by_topic: Dict[Tuple, List[Dict]] = {key: [] for key in topic_keys}
+        fetched_times: Dict[Tuple, Optional[datetime]] = {}
+        saturated_batches = []
+        for batch, fetched_at, saturated, articles in results:
+            for key in batch:
+                fetched_times[key] = fetched_at
+            for article in articles:
+                for key in batch:
+                    if len(batch) == 1 or self._article_matches_topic(article, key):
+                        fresh_by_topic[key].append(article)
+            if saturated:
+                saturated_batches.append(batch)
+        
+        # Темы переполненных пакетов, которым не хватило статей, загружаются отдельными запросами
+        starved = [
+            key for batch in saturated_batches for key in batch
+            if len(fresh_by_topic[key]) < self.ARTICLES_PER_TOPIC
+        ]
+        if starved:
+            logger.info(f"Пакетная загрузка: {len(saturated_batches)} пакетов заполнены целиком, "
+                        f"дозагружаем отдельно тем: {len(starved)}")
+            for key, ok, articles in await asyncio.gather(*(fetch_single(key) for key in starved)):
+                fresh_by_topic[key].extend(articles)
+                if not ok:
+                    # Статьи темы могли не попасть в пакет - отметка времени не сдвигается
+                    fetched_times[key] = None
+        
+        # Остальные источники (RSS) опрашиваются по темам: фильтрация лент локальная и дешевая
+        other_sources = [source for source in self.news_sources if not isinstance(source, NewsApiSource)]
+        if other_sources:
+            other_results = await asyncio.gather(*(
+                self.fetch_articles(key[0], key[1], priority=PRIORITY_BACKGROUND, keywords=list(key[2]),
+                                    extra_params={'from': since[key]} if since[key] else None,
+                                    sources=other_sources)
+                for key in topic_keys
+            ))
+            for key, articles in zip(topic_keys, other_results):
+                fresh_by_topic[key].extend(articles)
+        
+        requests_made = len(batches) + len(starved)
+        self.batch_requests_saved += len(topic_keys) - requests_made
+        logger.info(f"Пакетная загрузка: {requests_made} запросов к NewsAPI вместо {len(topic_keys)}")
+        
+        updated = await asyncio.gather(*(
+            self._update_topic_mark(key, fresh_by_topic[key], marks[key]) for key in topic_keys
+        ))
+        return {key: (fetched_times[key], articles) for key, articles in zip(topic_keys, updated)}
+    
+    async def fetch_topics(self, topic_keys: Iterable[Tuple]
+                           ) -> Dict[Tuple, Tuple[Optional[datetime], List[Dict]]]:
+        """Загружает новости по набору тем с ограничением параллельности
+
+        Для каждой темы возвращает (время начала загрузки, статьи); время None - тема не обновлена
+        (исчерпана квота), статьи в этом случае - накопленные ранее.
+        """
+        topic_keys = list(topic_keys)
+        if self.digest_batch_size > 1 and any(isinstance(source, NewsApiSource) for source in self.news_sources):
+            return await self._fetch_topics_batched(topic_keys)
+        
+        semaphore = asyncio.Semaphore(self.digest_fetch_concurrency)
+        
+        async def fetch(key: Tuple) -> Tuple[Tuple, Tuple[Optional[datetime], List[Dict]]]:
+            async with semaphore:
+                fetched_at = datetime.now()
+                try:
+                    articles = await self.get_news_since(key[0], key[1], list(key[2]), priority=PRIORITY_BACKGROUND)
+                except QuotaExceededError as e:
+                    logger.warning(f"Тема '{key[0]}' не обновлена: {e}")
+                    mark = await self._get_topic_mark(key)
+                    return key, (None, mark[1] if mark else [])
+                return key, (fetched_at, articles)
+        
+        results = await asyncio.gather(*(fetch(key) for key in topic_keys))
+        return dict(results)
+    
+    def _collect_digest_recipients(self, user_ids: Optional[Iterable[int]] = None
+                                   ) -> Tuple[List[Tuple[int, Dict]], Counter]:
+        """Получатели дайджеста (все или из user_ids) и число подписчиков каждой темы"""
+        # Список - снимок: словарь пользователей может меняться во время await
+        candidates = self.users_data.items() if user_ids is None else (
+            (user_id, self.users_data.get(user_id)) for user_id in user_ids
+        )
+        recipients = [
+            (user_id, user_data) for user_id, user_data in list(candidates)
+            if user_data and user_data.get('daily_digest', False) and user_data.get('topics')
+        ]
+        subscribers = Counter(
+            self._topic_key(topic_data['name'], topic_data.get('language', self.news_language),
+                            topic_data.get('keywords'))
+            for _, user_data in recipients
+            for topic_data in user_data['topics']
+        )
+        return recipients, subscribers
+    
+    async def prewarm_digest(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Заранее загружает самые популярные темы пользователей, чей дайджест скоро будет отправлен"""
+        _, subscribers = self._collect_digest_recipients(self.digest_scheduler.due_within(self.prewarm_window))
+        # Темы, прогретые недавно, повторно не загружаются
+        fresh_border = datetime.now() - timedelta(seconds=self.prewarm_max_age)
+        self.prewarmed = {
+            key: entry for key, entry in self.prewarmed.items() if entry[0] >= fresh_border
+        }
+        for key in self.prewarmed:
+            subscribers.pop(key, None)
+        if not subscribers:
+            return
+        ranked = [key for key, _ in subscribers.most_common(self.prewarm_top_topics or None)]
+        logger.info(f"Прогрев дайджеста: тем {len(ranked)} из {len(subscribers)}, остаток квоты NewsAPI: {self.news_quota.remaining()}")
+        
+        started = datetime.now()
+        news_by_topic = await self.fetch_topics(ranked)
+        # Темы, не обновленные из-за квоты, не считаются прогретыми
+        self.prewarmed.update({key: entry for key, entry in news_by_topic.items() if entry[0] is not None})
+        logger.info(f"Прогрев завершен за {(datetime.now() - started).total_seconds():.1f} сек")
+    
+    def _route_articles(self, news_by_topic: Dict[Tuple, List[Dict]]) -> Dict[Tuple, List[Dict]]:
+        """Оставляет в каждой теме статьи с ее ключевыми словами через общий индекс подписок"""
+        index = SubscriptionIndex(self.keyword_whole_words, self.keyword_stemming)
+        for key in news_by_topic:
+            index.add(key, key[2])
+        
+        # Одна и та же статья может прийти в нескольких темах - проверяем ее один раз
+        routes: Dict[int, Set[Tuple]] = {}
+        for articles in news_by_topic.values():
+            for article in articles:
+                if id(article) not in routes:
+                    routes[id(article)] = index.route(f"{article.get('title') or ''} {article.get('description') or ''}")
+        logger.info(f"Индекс подписок: {len(index)} тем, проверено статей: {index.scanned}")
+        
+        return {
+            key: [article for article in articles if key in routes[id(article)]]
+            for key, articles in news_by_topic.items()
+        }
+    
+    def _digest_signature(self, user_data: Dict) -> Tuple:
+        """Каноническая подпись дайджеста: темы в порядке пользователя и время прошлого дайджеста"""
+        return (
+            tuple(
+                (topic_data['name'],
+                 self._topic_key(topic_data['name'], topic_data.get('language', self.news_language),
+                                 topic_data.get('keywords', [])))
+                for topic_data in user_data['topics']
+            ),
+            user_data.get('last_digest')
+        )
+    
+    def _build_digest(self, user_data: Dict, news_by_topic: Dict[Tuple, List[Dict]],
+                      published_at: Dict[int, Optional[datetime]]) -> List[str]:
+        """Собирает тексты сообщений дайджеста (пустой список - новостей нет)"""
+        digest = MessageBuilder(self.block_renderer, "📰 <b>Ежедневный дайджест новостей</b>\n\n")
+        last_digest = self._parse_timestamp(user_data.get('last_digest'))
+        # Одна история не повторяется в разных темах дайджеста
+        deduplicator = ArticleDeduplicator(self.dedup_distance)
+        
+        for topic_data in user_data['topics']:
+            topic_name = topic_data['name']
+            keywords = topic_data.get('keywords', [])
+            
+            key = self._topic_key(topic_name, topic_data.get('language', self.news_language), keywords)
+            articles = news_by_topic.get(key, [])
+            if last_digest:
+                # Только статьи, вышедшие после предыдущего дайджеста пользователя
+                articles = [
+                    article for article in articles
+                    if published_at[id(article)] and published_at[id(article)] > last_digest
+                ]
+            articles = self.take_unique_articles(articles, deduplicator)
+            
+            digest.add_topic(topic_name, articles, separator=f"\n{TOPIC_SEPARATOR}\n\n")
+        
+        return digest.build() if digest else []
+    
+    def _digest_cutoff(self, user_data: Dict, fetched_times: Dict[Tuple, Optional[datetime]]) -> Optional[str]:
+        """Новое значение last_digest: самое раннее время загрузки тем пользователя
+
+        Статьи, вышедшие после загрузки, попадут в следующий дайджест. None - какая-то тема
+        не обновлена, и last_digest не сдвигается, чтобы ее статьи не потерялись.
+        """
+        times = [
+            fetched_times.get(self._topic_key(topic_data['name'], topic_data.get('language', self.news_language),
+                                              topic_data.get('keywords')))
+            for topic_data in user_data['topics']
+        ]
+        if not times or any(fetched_at is None for fetched_at in times):
+            return None
+        return min(times).isoformat()
+    
+    def _digest_delivered(self, user_id: int, user_data: Dict, cutoff: Optional[str]) -> Callable[[], None]:
+        """Действие после доставки дайджеста: запоминает время, до которого статьи уже учтены"""
+        def delivered() -> None:
+            previous = self._parse_timestamp(user_data.get('last_digest'))
+            new = self._parse_timestamp(cutoff)
+            if new is not None and (previous is None or new > previous):
+                user_data['last_digest'] = cutoff
+                self.save_user(user_id)
+            logger.info(f"Отправлен дайджест пользователю {user_id}")
+        return delivered
+    
+    async def dispatch_due_digests(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Отправляет дайджесты всем пользователям, чье время наступило, пачками по digest_batch_users"""
+        # Пачки обрабатываются, пока очередь не опустеет: пока идет проход, следующие срабатывания
+        # задачи пропускаются, поэтому одна пачка за проход не успевала бы за большой рассылкой
+        while True:
+            user_ids = self.digest_scheduler.pop_due(limit=self.digest_batch_users)
+            if not user_ids:
+                return
+            # Следующий дайджест - в то же время завтра
+            for user_id in user_ids:
+                self.schedule_user_digest(user_id)
+            await self.send_daily_digest(context, user_ids)
+    
+    async def send_daily_digest(self, context: ContextTypes.DEFAULT_TYPE,
+                                user_ids: Optional[List[int]] = None) -> None:
+        """Отправляет ежедневные дайджесты пользователям (по умолчанию всем)"""
+        logger.info(f"Начинаем отправку ежедневных дайджестов{f' ({len(user_ids)} пользователей)' if user_ids else ''}")
+        
+        # Фаза 1: собираем получателей и уникальные темы
+        recipients, subscribers = self._collect_digest_recipients(user_ids)
+        topic_keys = set(subscribers)
+        
+        # Фаза 2: каждая тема загружается один раз на весь прогон, прогретые темы берутся готовыми
+        run_started = datetime.now()
+        fresh_border = run_started - timedelta(seconds=self.prewarm_max_age)
+        warm = {
+            key: entry for key, entry in self.prewarmed.items()
+            if key in topic_keys and entry[0] >= fresh_border
+        }
+        news_by_topic = {key: articles for key, (_, articles) in warm.items()}
+        # Для прогретых тем учитывается время прогрева: статьи, вышедшие после него, попадут в следующий дайджест
+        fetched_times: Dict[Tuple, Optional[datetime]] = {key: fetched_at for key, (fetched_at, _) in warm.items()}
+        cold_keys = topic_keys - set(news_by_topic)
+        logger.info(f"Остаток квоты NewsAPI перед рассылкой: {self.news_quota.remaining()}, тем к загрузке: {len(cold_keys)}")
+        for key, (fetched_at, articles) in (await self.fetch_topics(cold_keys)).items():
+            news_by_topic[key] = articles
+            fetched_times[key] = fetched_at
+        
+        warm_topics = len(topic_keys) - len(cold_keys)
+        warm_share = warm_topics / len(topic_keys) * 100 if topic_keys else 0
+        warm_subscriptions = sum(count for key, count in subscribers.items() if key not in cold_keys)
+        logger.info(
+            f"Загружено тем: {len(topic_keys)} для {len(recipients)} пользователей; "
+            f"из прогрева: {warm_topics} тем ({warm_share:.0f}%), "
+            f"{warm_subscriptions} из {sum(subscribers.values())} подписок"
+        )
         
-        for user_id, user_data in self.users_data.items():
+        # Даты публикации разбираются один раз на весь прогон
+        published_at = {
+            id(article): self._parse_timestamp(article.get('publishedAt'))
+            for articles in news_by_topic.values()
+            for article in articles
+        }
+        
+        # Ключевые слова проверяются один раз для каждой статьи сразу по всем подпискам
+        news_by_topic = self._route_articles(news_by_topic)
+        # Все статьи прогона ранжируются одним пакетом
+        news_by_topic = self.ranker.rank(news_by_topic)
+        
+        # Фаза 3: один текст на каждый уникальный набор подписок, рассылка всем его пользователям
+        digests: Dict[Tuple, List[str]] = {}
+        jobs = []
+        for user_id, user_data in recipients:
             try:
-                if not user_data.get('daily_digest', False):
-                    continue
-                
-                topics = user_data.get('topics', [])
-                if not topics:
-                    continue
-                
-                digest_message = "📰 <b>Ежедневный дайджест новостей</b>\n\n"
-                has_news = False
-                
-                for topic_data in topics:
-                    topic_name = topic_data['name']
-                    keywords = topic_data.get('keywords', [])
-                    
-                    articles = self.get_news(topic_name)
-                    if keywords:
-                        articles = self.filter_news_by_keywords(articles, keywords)
-                    
-                    if articles:
-                        has_news = True
-                        digest_message += self.format_news_message(articles, topic_name)
-                        digest_message += "\n" + "="*50 + "\n\n"
-                
-                if has_news:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=digest_message,
-                        parse_mode='HTML',
-                        disable_web_page_preview=True
-                    )
-                    logger.info(f"Отправлен дайджест пользователю {user_id}")
-                else:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="📰 Сегодня новостей по вашим темам не найдено."
-                    )
-                
-                # Обновляем время последнего дайджеста
-                self.users_data[user_id]['last_digest'] = datetime.now().isoformat()
-                self.save_data()
-                
+                signature = self._digest_signature(user_data)
+                texts = digests.get(signature)
+                if texts is None:
+                    texts = self._build_digest(user_data, news_by_topic, published_at)
+                    digests[signature] = texts
             except Exception as e:
-                logger.error(f"Ошибка при отправке дайджеста пользователю {user_id}: {e}")
+                logger.error(f"Ошибка при подготовке дайджеста пользователю {user_id}: {e}")
+                continue
+            
+            if texts:
+                # Сообщение делится по границам статей в пределах лимита Telegram
+                messages = [
+                    {'text': text, 'parse_mode': 'HTML', 'disable_web_page_preview': True}
+                    for text in texts
+                ]
+            else:
+                messages = [{'text': "📰 Сегодня новостей по вашим темам не найдено."}]
+            cutoff = self._digest_cutoff(user_data, fetched_times)
+            jobs.append(DeliveryJob(user_id, messages, self._digest_delivered(user_id, user_data, cutoff)))
         
-        logger.info("Завершена отправка ежедневных дайджестов")
+        # Фаза 4: параллельная рассылка в пределах лимитов Telegram
+        await self.delivery.run(context.bot.send_message, jobs)
+        
+        self.digest_memo_stats = {'users': len(recipients), 'signatures': len(digests)}
+        logger.info(f"Собрано дайджестов: {len(digests)} для {len(recipients)} пользователей")
+        logger.info(f"Завершена отправка ежедневных дайджестов, статистика: {self.get_stats()}")
 
 # Создаем экземпляр бота
 news_bot = NewsBot()
 
+QUOTA_EXCEEDED_MESSAGE = "⏳ Лимит запросов к новостям на сегодня исчерпан, попробуйте позже."
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     user_id = update.effective_user.id
@@ -486,7 +1169,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User info - first_name: {user.first_name}, full_name: {user.full_name}, username: {user.username}, chosen: {user_name}")
     
     welcome_message = f"""
-👋 Привет, {user_name}!
+👋 Привет, {escape(user_name)}!
 
 Я универсальный бот для новостей и погоды!
 
@@ -499,6 +1182,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 /get_news - Получить новости по теме
 /digest - Получить дайджест новостей
 /toggle_digest - Включить/выключить ежедневные дайджесты
+/digest_time - Время ежедневного дайджеста
 /help - Показать справку
 
 <b>Как использовать:</b>
@@ -562,25 +1246,27 @@ async def my_topics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("📝 У вас пока нет добавленных тем.")
         return
     
-    message = "📝 <b>Ваши темы:</b>\n\n"
+    message = MessageBuilder(news_bot.block_renderer, "📝 <b>Ваши темы:</b>\n\n")
     for i, topic_data in enumerate(topics, 1):
         topic_name = topic_data['name']
         keywords = topic_data.get('keywords', [])
         added_at = topic_data.get('added_at', '')
         
-        message += f"{i}. <b>{topic_name}</b>\n"
+        block = [f"{i}. <b>{escape(topic_name)}</b>\n"]
         if keywords:
-            message += f"   🔍 Ключевые слова: {', '.join(keywords)}\n"
+            block.append(f"   🔍 Ключевые слова: {escape(', '.join(keywords))}\n")
         if added_at:
             try:
                 date_obj = datetime.fromisoformat(added_at)
                 formatted_date = date_obj.strftime('%d.%m.%Y')
-                message += f"   📅 Добавлено: {formatted_date}\n"
+                block.append(f"   📅 Добавлено: {formatted_date}\n")
             except:
                 pass
-        message += "\n"
+        block.append("\n")
+        message.add(''.join(block))
     
-    await update.message.reply_text(message, parse_mode='HTML')
+    for part in message.build():
+        await update.message.reply_text(part, parse_mode='HTML')
 
 async def get_news(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /get_news"""
@@ -595,31 +1281,38 @@ async def get_news(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     topic = ' '.join(context.args)
     
-    # Получаем новости
-    articles = news_bot.get_news(topic)
-    
-    if not articles:
-        await update.message.reply_text(f"📰 По теме '{topic}' новостей не найдено.")
-        return
-    
     # Проверяем, есть ли у пользователя эта тема с ключевыми словами
+    keywords = []
+    matcher = None
     user_topics = news_bot.get_user_topics(user_id)
     for topic_data in user_topics:
         if topic_data['name'].lower() == topic.lower():
             keywords = topic_data.get('keywords', [])
-            if keywords:
-                articles = news_bot.filter_news_by_keywords(articles, keywords)
+            matcher = news_bot.get_topic_matcher(topic_data)
             break
     
-    message = news_bot.format_news_message(articles, topic)
+    # Получаем новости (ключевые слова входят в запрос к NewsAPI)
+    try:
+        articles = await news_bot.fetch_articles(topic, keywords=keywords)
+    except QuotaExceededError:
+        await update.message.reply_text(QUOTA_EXCEEDED_MESSAGE)
+        return
+    if keywords:
+        articles = news_bot.filter_news_by_keywords(articles, keywords, matcher)
+    # Самые релевантные первыми; одна и та же новость от разных изданий показывается один раз
+    articles = news_bot.rank_topic_articles(articles, topic, keywords)
+    articles = news_bot.take_unique_articles(articles, ArticleDeduplicator(news_bot.dedup_distance))
+    
+    if not articles:
+        await update.message.reply_text(f"📰 По теме '{topic}' новостей не найдено.")
+        return
     
-    # Разбиваем сообщение на части, если оно слишком длинное
-    if len(message) > 4000:
-        parts = [message[i:i+4000] for i in range(0, len(message), 4000)]
-        for part in parts:
-            await update.message.reply_text(part, parse_mode='HTML', disable_web_page_preview=True)
-    else:
-        await update.message.reply_text(message, parse_mode='HTML', disable_web_page_preview=True)
+    message = MessageBuilder(news_bot.block_renderer)
+    message.add_topic(topic, articles)
+    
+    # Сообщение делится на части только по границам статей
+    for part in message.build():
+        await update.message.reply_text(part, parse_mode='HTML', disable_web_page_preview=True)
 
 async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /digest"""
@@ -630,9 +1323,10 @@ async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("📝 У вас нет добавленных тем для дайджеста.")
         return
     
-    digest_message = "📰 <b>Дайджест новостей</b>\n\n"
-    has_news = False
+    digest_message = MessageBuilder(news_bot.block_renderer)
     processed_topics = []
+    quota_exceeded = False
+    deduplicator = ArticleDeduplicator(news_bot.dedup_distance)
     
     for topic_data in topics:
         topic_name = topic_data['name']
@@ -641,32 +1335,79 @@ async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # Показываем прогресс
         await update.message.reply_text(f"🔍 Ищу новости по теме: {topic_name}...")
         
-        articles = news_bot.get_news(topic_name)
+        try:
+            articles = await news_bot.fetch_articles(topic_name, keywords=keywords)
+        except QuotaExceededError:
+            quota_exceeded = True
+            continue
         if keywords:
-            articles = news_bot.filter_news_by_keywords(articles, keywords)
+            articles = news_bot.filter_news_by_keywords(articles, keywords, news_bot.get_topic_matcher(topic_data))
+        articles = news_bot.rank_topic_articles(articles, topic_name, keywords, topic_data.get('language'))
+        articles = news_bot.take_unique_articles(articles, deduplicator)
         
         if articles:
-            has_news = True
             processed_topics.append(topic_name)
             # Добавляем тему в дайджест
-            digest_message += f"\n{'='*50}\n"
-            digest_message += news_bot.format_news_message(articles, topic_name)
-            digest_message += "\n"
-    
-    if has_news:
-        # Отправляем финальный дайджест
-        digest_message = f"📰 <b>Дайджест новостей</b>\n\nПросмотрено тем: {len(topics)}\nНайдено новостей: {len(processed_topics)}\n\n" + digest_message
-        
-        # Разбиваем сообщение на части, если оно слишком длинное
-        if len(digest_message) > 4000:
-            parts = [digest_message[i:i+4000] for i in range(0, len(digest_message), 4000)]
-            for part in parts:
-                await update.message.reply_text(part, parse_mode='HTML', disable_web_page_preview=True)
-        else:
-            await update.message.reply_text(digest_message, parse_mode='HTML', disable_web_page_preview=True)
+            digest_message.add_topic(topic_name, articles, separator=f"\n{TOPIC_SEPARATOR}\n\n")
+    
+    if digest_message:
+        # Отправляем финальный дайджест, разбитый по границам статей
+        digest_message.header = f"📰 <b>Дайджест новостей</b>\n\nПросмотрено тем: {len(topics)}\nНайдено новостей: {len(processed_topics)}\n\n"
+        if quota_exceeded:
+            digest_message.header += "⏳ Часть тем не загружена: исчерпан лимит запросов к новостям\n\n"
+        for part in digest_message.build():
+            await update.message.reply_text(part, parse_mode='HTML', disable_web_page_preview=True)
+    elif quota_exceeded:
+        await update.message.reply_text(QUOTA_EXCEEDED_MESSAGE)
     else:
         await update.message.reply_text("📰 Сегодня новостей по вашим темам не найдено.")
 
+async def digest_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /digest_time"""
+    user_id = update.effective_user.id
+    user_data = news_bot.users_data.get(user_id, {})
+    
+    if not context.args:
+        current_time = user_data.get('digest_time') or os.getenv('DIGEST_TIME', '09:00')
+        current_zone = user_data.get('timezone') or os.getenv('DIGEST_TIMEZONE') or 'время сервера'
+        await update.message.reply_text(
+            f"⏰ Время дайджеста: {current_time} ({current_zone})\n\n"
+            "Использование: /digest_time ЧЧ:ММ [часовой пояс]\n"
+            "Пример: /digest_time 08:30 Europe/Moscow\n"
+            "Сбросить часовой пояс: /digest_time 08:30 default"
+        )
+        return
+    
+    try:
+        hour, minute = parse_digest_time(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Укажите время в формате ЧЧ:ММ, например: /digest_time 08:30")
+        return
+    
+    timezone_name = context.args[1] if len(context.args) > 1 else None
+    # "default" возвращает часовой пояс по умолчанию (DIGEST_TIMEZONE или время сервера)
+    clear_timezone = bool(timezone_name) and timezone_name.lower() == 'default'
+    if timezone_name and not clear_timezone and get_timezone(timezone_name) is None:
+        await update.message.reply_text(
+            f"❌ Неизвестный часовой пояс: {timezone_name}\n"
+            "Примеры: Europe/Moscow, Asia/Yekaterinburg, UTC"
+        )
+        return
+    
+    next_run = news_bot.set_digest_time(user_id, f"{hour:02d}:{minute:02d}", timezone_name, clear_timezone)
+    user_data = news_bot.users_data[user_id]
+    zone = get_timezone(user_data.get('timezone')) or news_bot.digest_scheduler.default_timezone
+    message = f"⏰ Дайджест будет приходить в {hour:02d}:{minute:02d}"
+    if user_data.get('timezone'):
+        message += f" ({user_data['timezone']})"
+    if next_run is not None:
+        message += f"\n📅 Ближайший: {datetime.fromtimestamp(next_run, zone).strftime('%d.%m.%Y %H:%M')}"
+    elif not user_data.get('daily_digest', True):
+        message += "\n\nЕжедневные дайджесты выключены, включите их командой /toggle_digest"
+    else:
+        message += "\n\nДайджест придет, когда вы добавите тему командой /add_topic"
+    await update.message.reply_text(message)
+
 async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /toggle_digest"""
     user_id = update.effective_user.id
@@ -691,7 +1432,7 @@ async def weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(f"🌤️ Получаю погоду для {location}...")
     
     # Получаем данные о погоде
-    weather_data = news_bot.get_weather(location)
+    weather_data = await news_bot.get_weather(location)
     
     if weather_data:
         # Форматируем и отправляем сообщение
@@ -726,6 +1467,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 <b>Настройки:</b>
 /toggle_digest - Включить/выключить ежедневные дайджесты
+/digest_time &lt;ЧЧ:ММ&gt; [часовой пояс] - Время ежедневного дайджеста (default - пояс по умолчанию)
 
 <b>Примеры использования:</b>
 /weather Москва
@@ -752,6 +1494,37 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except Exception as e:
             logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
 
+async def post_shutdown(app: Application) -> None:
+    """Сохраняет данные при остановке бота"""
+    await news_bot.shutdown()
+    logger.info("Данные сохранены, бот остановлен")
+
+def schedule_jobs(job_queue) -> None:
+    """Регистрирует периодические задачи: прогрев, дайджест и очистку кэша"""
+    # Планировщик проверяет, чей дайджест пора отправить, и обрабатывает всех таких пользователей пачками
+    job_queue.run_repeating(
+        news_bot.dispatch_due_digests,
+        interval=int(os.getenv('DIGEST_TICK_SECONDS', '30')),
+        first=10,
+        name="daily_digest"
+    )
+    
+    # Прогрев кэша для пользователей, чей дайджест будет отправлен в ближайшие PREWARM_MINUTES минут
+    if news_bot.prewarm_window > 0:
+        job_queue.run_repeating(
+            news_bot.prewarm_digest,
+            interval=max(60, news_bot.prewarm_window // 2),
+            first=5,
+            name="prewarm_digest"
+        )
+    
+    job_queue.run_repeating(
+        news_bot.vacuum_article_cache,
+        interval=int(os.getenv('ARTICLE_CACHE_VACUUM_INTERVAL', str(6 * 3600))),
+        first=60,
+        name="vacuum_article_cache"
+    )
+
 def main() -> None:
     """Основная функция для запуска бота"""
     # Получаем токен бота из переменных окружения
@@ -773,13 +1546,21 @@ def main() -> None:
             BotCommand("my_topics", "📋 Мои темы для новостей"),
             BotCommand("digest", "📅 Получить дайджест новостей"),
             BotCommand("toggle_digest", "⚙️ Вкл/выкл ежедневный дайджест"),
+            BotCommand("digest_time", "⏰ Время ежедневного дайджеста"),
             BotCommand("help", "ℹ️ Справка по командам")
         ]
         await app.bot.set_my_commands(commands)
         logger.info("Меню команд настроено")
+        await news_bot.start()
     
-    # Создаем приложение с post_init
-    application = Application.builder().token(bot_token).post_init(post_init).build()
+    # Создаем приложение с post_init и post_shutdown
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start))
@@ -790,21 +1571,18 @@ def main() -> None:
     application.add_handler(CommandHandler("get_news", get_news))
     application.add_handler(CommandHandler("digest", digest))
     application.add_handler(CommandHandler("toggle_digest", toggle_digest))
+    application.add_handler(CommandHandler("digest_time", digest_time))
     application.add_handler(CommandHandler("help", help_command))
     
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
     
-    # Настраиваем ежедневные дайджесты (каждый день в 9:00)
+    # Настраиваем ежедневные дайджесты (по умолчанию каждый день в 9:00)
     # Примечание: JobQueue требует дополнительной установки, делаем опционально
     try:
         job_queue = application.job_queue
         if job_queue:
-            job_queue.run_daily(
-                news_bot.send_daily_digest,
-                time=datetime.strptime("09:00", "%H:%M").time(),
-                name="daily_digest"
-            )
+            schedule_jobs(job_queue)
             logger.info("Ежедневные дайджесты включены")
         else:
             logger.warning("JobQueue не доступен - ежедневные дайджесты отключены")
@@ -843,12 +1621,20 @@ def main_webhook() -> None:
             BotCommand("my_topics", "📋 Мои темы для новостей"),
             BotCommand("digest", "📅 Получить дайджест новостей"),
             BotCommand("toggle_digest", "⚙️ Вкл/выкл ежедневный дайджест"),
+            BotCommand("digest_time", "⏰ Время ежедневного дайджеста"),
             BotCommand("help", "ℹ️ Справка по командам")
         ]
         await app.bot.set_my_commands(commands)
         logger.info("Меню команд настроено (webhook)")
+        await news_bot.start()
 
-    application = Application.builder().token(bot_token).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("weather", weather))
@@ -858,6 +1644,7 @@ def main_webhook() -> None:
     application.add_handler(CommandHandler("get_news", get_news))
     application.add_handler(CommandHandler("digest", digest))
     application.add_handler(CommandHandler("toggle_digest", toggle_digest))
+    application.add_handler(CommandHandler("digest_time", digest_time))
     application.add_handler(CommandHandler("help", help_command))
 
     application.add_error_handler(error_handler)
@@ -865,11 +1652,7 @@ def main_webhook() -> None:
     try:
         job_queue = application.job_queue
         if job_queue:
-            job_queue.run_daily(
-                news_bot.send_daily_digest,
-                time=datetime.strptime("09:00", "%H:%M").time(),
-                name="daily_digest"
-            )
+            schedule_jobs(job_queue)
             logger.info("Ежедневные дайджесты включены")
     except Exception as e:
         logger.warning(f"JobQueue не активирован: {e}")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Кэши в памяти процесса для ответов внешних API
+TTL + LRU вытеснение, счетчики попаданий, режим stale-while-revalidate
+и объединение одновременных одинаковых запросов (single-flight)
+"""
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """Значение в кэше вместе со временем сохранения"""
+
+    __slots__ = ('value', 'stored_at')
+
+    def __init__(self, value: Any, stored_at: float):
+        self.value = value
+        self.stored_at = stored_at
+
+    @property
+    def age(self) -> float:
+        """Возраст записи в секундах"""
+        return time.monotonic() - self.stored_at
+
+
+class TTLCache:
+    """Кэш с ограниченным размером (LRU) и временем жизни записей"""
+
+    def __init__(self, maxsize: int = 512, ttl: float = 600, stale_ttl: float = 0, name: str = 'cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Сколько секунд после истечения TTL запись еще можно отдавать, обновляя в фоне
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self._entries: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self._refreshing: Set[Hashable] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_entry(self, key: Hashable) -> Optional[CacheEntry]:
+        """Возвращает запись, пока она свежая или в окне устаревания (без учета в счетчиках)"""
+        entry = self._entries.get(key)
+        if entry is None or entry.age > self.ttl + self.stale_ttl:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def peek(self, key: Hashable) -> Optional[CacheEntry]:
+        """Возвращает запись любого возраста (пока она не вытеснена)"""
+        return self._entries.get(key)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Возвращает свежее значение или None"""
+        entry = self.get_entry(key)
+        if entry is None or entry.age > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Сохраняет значение, вытесняя самые давно использованные записи"""
+        self._entries[key] = CacheEntry(value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает значение из кэша или загружает его через fetch
+
+        Устаревшая запись в окне stale_ttl отдается сразу, а обновление запускается в фоне.
+        Исключения fetch не кэшируются и пробрасываются вызывающему.
+        """
+        entry = self.get_entry(key)
+        if entry is not None:
+            if entry.age <= self.ttl:
+                self.hits += 1
+                return entry.value
+            if self.stale_ttl > 0:
+                self.stale_hits += 1
+                self._schedule_refresh(key, fetch)
+                return entry.value
+
+        self.misses += 1
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def _schedule_refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> None:
+        """Запускает фоновое обновление записи (не более одного на ключ)"""
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def refresh() -> None:
+            try:
+                self.set(key, await fetch())
+            except Exception as e:
+                logger.warning(f"{self.name}: не удалось обновить устаревшую запись {key}: {e}")
+            finally:
+                self._refreshing.discard(key)
+
+        # Храним ссылку на задачу, чтобы ее не собрал сборщик мусора
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики кэша"""
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions
+        }
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в один запрос"""
+
+    def __init__(self, name: str = 'flight'):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет fetch или присоединяется к уже выполняющемуся запросу с тем же ключом"""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            # Запрос выполняется отдельной задачей: отмена одного из ожидающих не отменяет его для остальных
+            task = asyncio.get_running_loop().create_task(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики запросов"""
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._inflight)
+        }
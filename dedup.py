@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Удаление повторов статей между темами и изданиями
+Ссылки приводятся к каноническому виду (без UTM-меток и AMP-версий),
+почти одинаковые заголовки и описания находятся по SimHash основ слов с поиском по полосам отпечатка
+"""
+
+import hashlib
+from functools import lru_cache
+from typing import Dict, List, Set, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from matching import WORD_RE, normalize_text
+
+# Параметры ссылок, которые не меняют содержимое страницы
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'yclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid',
+    'ref', 'ref_src', 'ref_url', 'cmpid', 'ncid', 'ocid', 'spm', 'amp', 'outputtype'
+}
+TRACKING_PREFIXES = ('utm_', 'ga_', '_hs', 'at_', 'pk_', 'itm_')
+
+SIMHASH_BITS = 64
+# Порог по умолчанию подобран на парах "заголовок + описание" одной новости из разных изданий:
+# пересказы одной новости отличаются на 0-15 бит, разные новости одной темы - на 18 бит и больше
+DEFAULT_MAX_DISTANCE = 16
+
+
+def canonicalize_url(url: str) -> str:
+    """Канонический вид ссылки: без схемы, www, AMP-вариантов, меток отслеживания и якоря"""
+    if not url:
+        return ''
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'amp.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    # Страницы Google AMP Cache: example-com.cdn.ampproject.org/c/s/example.com/...
+    path = parts.path
+    if host.endswith('.cdn.ampproject.org'):
+        segments = [segment for segment in path.split('/') if segment]
+        while segments and segments[0] in ('c', 'v', 's', 'i'):
+            segments.pop(0)
+        if segments:
+            host, path = segments[0].lower(), '/' + '/'.join(segments[1:])
+
+    segments = [segment for segment in path.split('/') if segment and segment.lower() != 'amp']
+    path = '/' + '/'.join(segments)
+    if path.endswith('.amp'):
+        path = path[:-len('.amp')]
+    elif path.endswith('.amp.html'):
+        path = path[:-len('.amp.html')] + '.html'
+
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES)
+    ]
+    return urlunsplit(('', host, path.rstrip('/') or '/', urlencode(sorted(query)), '')).lstrip('/')
+
+
+def _feature_hash(feature: str) -> int:
+    """64-битный хэш признака"""
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+@lru_cache(maxsize=4096)
+def simhash(text: str) -> int:
+    """SimHash текста по основам слов
+
+    Пары соседних слов не учитываются: в коротких текстах перестановка слов при пересказе
+    меняет большинство пар и отдаляет отпечатки одной новости.
+    """
+    features = WORD_RE.findall(normalize_text(text, stem=True))
+    if not features:
+        return 0
+
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        value = _feature_hash(feature)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Число различающихся бит"""
+    return bin(first ^ second).count('1')
+
+
+class ArticleDeduplicator:
+    """Отсеивает повторы: одинаковые канонические ссылки и близкие по SimHash тексты
+
+    Отпечаток делится на max_distance + 1 полос: у отпечатков, отличающихся не более
+    чем на max_distance бит, хотя бы одна полоса совпадает, поэтому сравниваются
+    только кандидаты из тех же полос, а не все ранее принятые статьи.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = SIMHASH_BITS // self.bands
+        self._urls: Set[str] = set()
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        self.duplicates = 0
+
+    def _band_keys(self, fingerprint: int) -> List[Tuple[int, int]]:
+        """Ключи полос отпечатка"""
+        mask = (1 << self.band_bits) - 1
+        return [(band, fingerprint >> (band * self.band_bits) & mask) for band in range(self.bands)]
+
+    def is_duplicate(self, article: Dict) -> bool:
+        """Проверяет статью и запоминает ее, если это не повтор"""
+        url = canonicalize_url(article.get('url') or '')
+        if url and url in self._urls:
+            self.duplicates += 1
+            return True
+
+        text = f"{article.get('title') or ''} {article.get('description') or ''}"
+        fingerprint = simhash(text) if text.strip() else None
+        if fingerprint is not None:
+            band_keys = self._band_keys(fingerprint)
+            for band_key in band_keys:
+                for candidate in self._buckets.get(band_key, ()):
+                    if hamming_distance(fingerprint, candidate) <= self.max_distance:
+                        self.duplicates += 1
+                        return True
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, []).append(fingerprint)
+
+        if url:
+            self._urls.add(url)
+        return False
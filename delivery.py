@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Параллельная рассылка сообщений с учетом ограничений Telegram
+Общий token bucket (~30 сообщений в секунду на бота), не чаще 1 сообщения в секунду в один чат,
+ограниченное число одновременных отправок и пауза всей рассылки по RetryAfter
+"""
+
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryJob:
+    """Сообщения для одного чата и действие после успешной доставки всех сообщений"""
+
+    __slots__ = ('chat_id', 'messages', 'on_delivered')
+
+    def __init__(self, chat_id: int, messages: List[Dict],
+                 on_delivered: Optional[Callable[[], None]] = None):
+        self.chat_id = chat_id
+        # Аргументы send_message для каждого сообщения (кроме chat_id)
+        self.messages = messages
+        self.on_delivered = on_delivered
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из RetryAfter (число секунд или timedelta в новых версиях библиотеки)"""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class DeliveryEngine:
+    """Рассылает сообщения параллельно в пределах лимитов Telegram"""
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, concurrency: int = 30,
+                 max_retries: int = 3, max_flood_waits: int = 5):
+        # Bucket общий для всех рассылок бота
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = 1 / chat_rate if chat_rate > 0 else 0
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_flood_waits = max_flood_waits
+        self.stats_counters = {'delivered': 0, 'failed': 0, 'messages': 0, 'retries': 0, 'flood_waits': 0}
+
+    async def _send_one(self, send: Callable[..., Awaitable], chat_id: int, message: Dict) -> None:
+        """Отправляет одно сообщение: RetryAfter приостанавливает всю рассылку, сетевые ошибки повторяются"""
+        errors = 0
+        flood_waits = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await send(chat_id=chat_id, **message)
+                self.stats_counters['messages'] += 1
+                return
+            except RetryAfter as e:
+                # Лимит общий для бота: останавливаем выдачу токенов всем отправителям
+                flood_waits += 1
+                self.stats_counters['flood_waits'] += 1
+                delay = _retry_after_seconds(e)
+                self.bucket.pause(delay)
+                logger.warning(f"Telegram ограничил частоту отправки, пауза рассылки {delay:.0f} сек")
+                if flood_waits > self.max_flood_waits:
+                    raise
+            except (BadRequest, Forbidden):
+                # Пользователь заблокировал бота или сообщение некорректно - повтор не поможет
+                raise
+            except NetworkError:
+                errors += 1
+                if errors > self.max_retries:
+                    raise
+                self.stats_counters['retries'] += 1
+                await asyncio.sleep(min(2 ** errors, 30))
+
+    async def _deliver(self, send: Callable[..., Awaitable], job: DeliveryJob) -> None:
+        """Доставляет все сообщения задания по порядку с интервалом для одного чата"""
+        last_sent = 0.0
+        for message in job.messages:
+            wait = last_sent + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._send_one(send, job.chat_id, message)
+            last_sent = time.monotonic()
+        if job.on_delivered is not None:
+            job.on_delivered()
+
+    async def run(self, send: Callable[..., Awaitable], jobs: Iterable[DeliveryJob]) -> Dict[str, int]:
+        """Рассылает задания не более чем concurrency одновременно; возвращает счетчики рассылки
+
+        send - функция отправки с сигнатурой bot.send_message(chat_id=..., text=..., ...).
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        started = time.monotonic()
+        messages_before = self.stats_counters['messages']
+
+        async def worker() -> None:
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._deliver(send, job)
+                    self.stats_counters['delivered'] += 1
+                except Exception as e:
+                    self.stats_counters['failed'] += 1
+                    logger.error(f"Не удалось доставить сообщение в чат {job.chat_id}: {e}")
+
+        workers = min(self.concurrency, queue.qsize())
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+        elapsed = time.monotonic() - started
+        sent = self.stats_counters['messages'] - messages_before
+        logger.info(f"Рассылка: отправлено {sent} сообщений за {elapsed:.1f} сек "
+                    f"({sent / elapsed if elapsed > 0 else 0:.1f} в сек)")
+        return self.stats()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики рассылки"""
+        return dict(self.stats_counters)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Поиск ключевых слов в тексте статей
+Текст и ключевые слова нормализуются (регистр, ё -> е, основы слов для русского и английского),
+ключевые слова темы компилируются один раз в автомат Ахо-Корасик,
+после чего проверка статьи - один линейный проход по тексту независимо от числа слов
+"""
+
+import re
+import logging
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import snowballstemmer
+except ImportError:
+    snowballstemmer = None
+    logger.warning("snowballstemmer не установлен, ключевые слова ищутся без учета словоформ")
+
+WORD_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+_stemmers: Dict[str, object] = {}
+
+
+def _get_stemmer(language: str):
+    """Стеммер Snowball для языка (создается один раз)"""
+    stemmer = _stemmers.get(language)
+    if stemmer is None:
+        stemmer = snowballstemmer.stemmer(language)
+        _stemmers[language] = stemmer
+    return stemmer
+
+
+@lru_cache(maxsize=65536)
+def stem_word(word: str) -> str:
+    """Основа слова: русский стеммер для кириллицы, английский для латиницы"""
+    if snowballstemmer is None or len(word) < 4 or word.isdigit():
+        return word
+    language = 'russian' if CYRILLIC_RE.search(word) else 'english'
+    return _get_stemmer(language).stemWord(word)
+
+
+def normalize_text(text: str, stem: bool = False) -> str:
+    """Нижний регистр, ё -> е и одиночные пробелы; при stem=True слова заменяются основами
+
+    Знаки препинания сохраняются, поэтому ключевые слова вроде "c++" продолжают работать.
+    """
+    text = ' '.join(text.casefold().replace('ё', 'е').split())
+    if stem:
+        text = WORD_RE.sub(lambda match: stem_word(match.group()), text)
+    return text
+
+
+@lru_cache(maxsize=4096)
+def normalize_article_text(text: str, stem: bool = False) -> str:
+    """Нормализованный текст статьи (одна и та же статья нормализуется один раз)"""
+    return normalize_text(text, stem)
+
+
+def _is_word_char(ch: str) -> bool:
+    """Символ, который считается частью слова"""
+    return ch.isalnum() or ch == '_'
+
+
+class KeywordMatcher:
+    """Автомат Ахо-Корасик по набору ключевых слов
+
+    Ключевое слово в кавычках ("машинное обучение") ищется как целая фраза с границами слов,
+    остальные - как подстрока (так "нейросет" находит "нейросетей"). При whole_words=True
+    границы слов проверяются для всех ключевых слов. При stem=True слова ключевых слов
+    и текста сравниваются по основам ("нейросети" находит "нейросетями").
+    """
+
+    def __init__(self, keywords: Tuple[str, ...], whole_words: bool = False, stem: bool = False):
+        # Исходный набор слов: по нему проверяется, что автомат соответствует записи темы
+        self.source = tuple(keywords)
+        self.whole_words = whole_words
+        self.stem = stem
+        self.patterns: List[str] = []
+        # Исходное ключевое слово для каждого слова автомата
+        self.pattern_sources: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Для каждого состояния: (индекс слова, длина, проверять границы слов)
+        self._out: List[List[Tuple[int, int, bool]]] = [[]]
+
+        for keyword in self.source:
+            stripped = keyword.strip()
+            phrase = len(stripped) > 1 and stripped[0] == stripped[-1] == '"'
+            pattern = normalize_text(stripped.strip('"'), stem)
+            if pattern:
+                self._add(pattern, whole_words or phrase)
+                self.pattern_sources.append(keyword)
+        self._build()
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def _add(self, pattern: str, bounded: bool) -> None:
+        """Добавляет слово в бор"""
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = next_state
+        self._out[state].append((len(self.patterns), len(pattern), bounded))
+        self.patterns.append(pattern)
+
+    def _build(self) -> None:
+        """Строит суффиксные ссылки обходом бора в ширину"""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                # Слова, оканчивающиеся в суффиксе, находятся и в этом состоянии
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def _scan(self, text: str, first_only: bool) -> Set[int]:
+        """Проход автомата по нормализованному тексту; возвращает индексы найденных слов"""
+        found: Set[int] = set()
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        last = len(text) - 1
+        for position, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for index, length, bounded in out[state]:
+                if bounded:
+                    start = position - length + 1
+                    if start > 0 and _is_word_char(text[start - 1]):
+                        continue
+                    if position < last and _is_word_char(text[position + 1]):
+                        continue
+                found.add(index)
+                if first_only:
+                    return found
+        return found
+
+    def matches(self, text: str) -> bool:
+        """Есть ли в тексте хотя бы одно ключевое слово"""
+        return bool(self.patterns) and bool(self._scan(normalize_article_text(text, self.stem), first_only=True))
+
+    def find_sources(self, text: str) -> Set[str]:
+        """Исходные ключевые слова (как переданы в конструктор), найденные в тексте"""
+        if not self.patterns:
+            return set()
+        return {self.pattern_sources[index] for index in self._scan(normalize_article_text(text, self.stem), first_only=False)}
+
+
+@lru_cache(maxsize=1024)
+def compile_keywords(keywords: Tuple[str, ...], whole_words: bool = False, stem: bool = False) -> KeywordMatcher:
+    """Компилирует набор ключевых слов (повторные наборы берутся из кэша)"""
+    return KeywordMatcher(keywords, whole_words, stem)
+
+
+class SubscriptionIndex:
+    """Обратный индекс подписок: ключевое слово -> подписки, в которых оно есть
+
+    Все ключевые слова всех подписок собираются в один автомат, поэтому каждая статья
+    проверяется одним проходом и сразу распределяется по всем подходящим подпискам.
+    Подписки без ключевых слов получают все статьи.
+    """
+
+    def __init__(self, whole_words: bool = False, stem: bool = False):
+        self.whole_words = whole_words
+        self.stem = stem
+        self._by_keyword: Dict[str, Set[Hashable]] = {}
+        self._unfiltered: Set[Hashable] = set()
+        self._matcher = None
+        self.scanned = 0
+
+    def add(self, subscription: Hashable, keywords: Iterable[str]) -> None:
+        """Добавляет подписку с ее ключевыми словами"""
+        keywords = [keyword for keyword in keywords if normalize_text(keyword.strip('"'))]
+        if not keywords:
+            self._unfiltered.add(subscription)
+        for keyword in keywords:
+            self._by_keyword.setdefault(keyword, set()).add(subscription)
+        self._matcher = None
+
+    def route(self, text: str) -> Set[Hashable]:
+        """Подписки, которым подходит текст"""
+        if self._matcher is None:
+            self._matcher = KeywordMatcher(tuple(self._by_keyword), self.whole_words, self.stem)
+        self.scanned += 1
+        subscriptions = set(self._unfiltered)
+        for keyword in self._matcher.find_sources(text):
+            subscriptions |= self._by_keyword[keyword]
+        return subscriptions
+
+    def __len__(self) -> int:
+        return len(self._unfiltered) + len({s for subs in self._by_keyword.values() for s in subs})
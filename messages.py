@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Сборка HTML сообщений для Telegram
+Текст статей экранируется, сообщение собирается из блоков (тема, статья)
+и делится на части только по границам блоков в пределах лимита Telegram
+"""
+
+import html
+from datetime import datetime
+from typing import Dict, List
+
+from caching import TTLCache
+
+# Лимит длины сообщения Telegram; длина считается по HTML с тегами, т.е. с запасом
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+TITLE_MAX_LENGTH = 300
+DESCRIPTION_MAX_LENGTH = 200
+
+TOPIC_SEPARATOR = "=" * 50
+
+# Версия шаблона блока статьи: увеличивается при изменении разметки, чтобы не отдавать старые блоки из кэша
+TEMPLATE_VERSION = 1
+
+
+def escape(text) -> str:
+    """Экранирует текст для parse_mode=HTML"""
+    return html.escape(str(text), quote=False)
+
+
+def escape_attribute(text) -> str:
+    """Экранирует значение атрибута (ссылки) для parse_mode=HTML"""
+    return html.escape(str(text), quote=True)
+
+
+def _truncate(text: str, limit: int) -> str:
+    """Обрезает текст до limit символов с многоточием"""
+    return f"{text[:limit]}..." if len(text) > limit else text
+
+
+def format_date(published_at: str) -> str:
+    """Дата публикации статьи для сообщения"""
+    try:
+        date_obj = datetime.fromisoformat(published_at.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return 'Дата неизвестна'
+    return date_obj.strftime('%d.%m.%Y %H:%M')
+
+
+def render_topic_header(topic: str) -> str:
+    """Заголовок темы"""
+    return f"📰 <b>Новости по теме: {escape(topic)}</b>\n\n"
+
+
+def render_article_body(article: Dict) -> str:
+    """Блок одной статьи без номера"""
+    title = article.get('title') or 'Без заголовка'
+    description = article.get('description') or ''
+    url = article.get('url') or ''
+
+    parts = [f"<b>{escape(_truncate(title, TITLE_MAX_LENGTH))}</b>\n"]
+    if description:
+        parts.append(f"   {escape(_truncate(description, DESCRIPTION_MAX_LENGTH))}\n")
+    if url:
+        parts.append(f"   🔗 <a href=\"{escape_attribute(url)}\">Читать далее</a>\n")
+    parts.append(f"   📅 {format_date(article.get('publishedAt') or '')}\n\n")
+    return ''.join(parts)
+
+
+class BlockRenderer:
+    """Рендер блоков статей с общим LRU кэшем по (URL статьи, версия шаблона)
+
+    Блок статьи собирается один раз и переиспользуется для всех пользователей и тем;
+    номер статьи в списке добавляется при сборке сообщения.
+    """
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 6 * 3600):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, name='rendered_blocks')
+
+    def render(self, index: int, article: Dict) -> str:
+        """Блок статьи с номером"""
+        url = article.get('url')
+        if not url:
+            return f"{index}. {render_article_body(article)}"
+        key = (url, TEMPLATE_VERSION)
+        body = self.cache.get(key)
+        if body is None:
+            body = render_article_body(article)
+            self.cache.set(key, body)
+        return f"{index}. {body}"
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики кэша блоков"""
+        return self.cache.stats()
+
+
+class MessageBuilder:
+    """Накапливает готовые HTML блоки и делит их на сообщения не длиннее limit"""
+
+    def __init__(self, renderer: BlockRenderer, header: str = '', limit: int = TELEGRAM_MESSAGE_LIMIT):
+        # Общий рендер бота: его кэш настраивается RENDER_CACHE_SIZE и RENDER_CACHE_TTL
+        self.renderer = renderer
+        # Заголовок добавляется только в первое сообщение
+        self.header = header
+        self.limit = limit
+        self._blocks: List[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self._blocks)
+
+    def add(self, block: str) -> None:
+        """Добавляет блок; блок не разрывается между сообщениями"""
+        if block:
+            self._blocks.append(block)
+
+    def add_topic(self, topic: str, articles: List[Dict], separator: str = '') -> None:
+        """Добавляет заголовок темы и блоки статей (заголовок не остается в конце сообщения без статей)"""
+        blocks = [self.renderer.render(index, article) for index, article in enumerate(articles, 1)]
+        if blocks:
+            blocks[0] = render_topic_header(topic) + blocks[0]
+            blocks[-1] += separator
+        for block in blocks:
+            self.add(block)
+
+    def _split_block(self, block: str) -> List[str]:
+        """Делит блок длиннее лимита по строкам (строки длиннее лимита - по символам)"""
+        pieces = []
+        for line in block.splitlines(keepends=True):
+            while len(line) > self.limit:
+                pieces.append(line[:self.limit])
+                line = line[self.limit:]
+            pieces.append(line)
+        return pieces
+
+    def build(self) -> List[str]:
+        """Возвращает тексты сообщений"""
+        messages: List[str] = []
+        current: List[str] = []
+        length = 0
+        blocks = [self.header] + self._blocks if self.header else self._blocks
+        for block in blocks:
+            for piece in ([block] if len(block) <= self.limit else self._split_block(block)):
+                if current and length + len(piece) > self.limit:
+                    messages.append(''.join(current).rstrip())
+                    current, length = [], 0
+                current.append(piece)
+                length += len(piece)
+        if current:
+            messages.append(''.join(current).rstrip())
+        return [message for message in messages if message]
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Источники новостей: NewsAPI и RSS/Atom ленты
+Все источники возвращают статьи в формате NewsAPI (title, description, url, publishedAt, source)
+"""
+
+import os
+import re
+import html
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+from dedup import canonicalize_url
+from matching import normalize_article_text, normalize_text
+from upstream import UpstreamClient, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при чтении ленты из файла
+READ_CHUNK_SIZE = 64 * 1024
+
+# Теги HTML в описаниях записей лент
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Максимальная длина параметра q в NewsAPI
+NEWSAPI_MAX_QUERY_LENGTH = 500
+NEWSAPI_OPERATORS = ('AND', 'OR', 'NOT')
+# Размер страницы NewsAPI, когда ключевые слова проверяются только локально:
+# фильтру нужно больше статей по теме, чтобы среди них нашлись статьи с ключевыми словами
+LOCAL_FILTER_PAGE_SIZE = 50
+
+
+def _query_term(text: str) -> str:
+    """Экранирует слово или фразу для языка запросов NewsAPI"""
+    term = ' '.join(text.replace('"', ' ').split()).lstrip('+-')
+    if ' ' in term or term.upper() in NEWSAPI_OPERATORS or any(ch in term for ch in '()'):
+        return f'"{term}"'
+    return term
+
+
+def is_upstream_keyword(keyword: str, whole_words: bool = False, stem: bool = False) -> bool:
+    """Совпадает ли локальный поиск ключевого слова с поиском NewsAPI (только целые слова)
+
+    Локальный фильтр ищет подстроки ("нейросет" находит "нейросетей") и при stem=True
+    сравнивает основы слов - NewsAPI таких статей не вернет.
+    """
+    stripped = keyword.strip()
+    phrase = len(stripped) > 1 and stripped[0] == stripped[-1] == '"'
+    return (whole_words or phrase) and not stem
+
+
+def plan_news_query(topic: str, keywords: Optional[List[str]] = None,
+                    max_length: int = NEWSAPI_MAX_QUERY_LENGTH,
+                    whole_words: bool = False, stem: bool = False,
+                    local_page_size: int = LOCAL_FILTER_PAGE_SIZE) -> Dict[str, Union[str, int]]:
+    """Компилирует тему и ключевые слова в параметры NewsAPI: q, searchIn и pageSize
+
+    Тема остается обычным запросом, ключевые слова объединяются через OR:
+    "тема AND (слово OR \"фраза из слов\")". Ключевые слова передаются в NewsAPI, только если
+    все они ищутся локально так же, как в NewsAPI (см. is_upstream_keyword) и влезают в лимит длины;
+    на практике это KEYWORD_WHOLE_WORDS=true и KEYWORD_STEMMING=false (или только фразы в кавычках
+    без стемминга). Иначе запрашивается только тема со страницей local_page_size статей,
+    а ключевые слова проверяет локальный фильтр.
+    """
+    topic_query = ' '.join(topic.replace('"', ' ').split())
+    keywords = keywords or []
+    local_only = {'q': topic_query, 'pageSize': local_page_size}
+    if not all(is_upstream_keyword(keyword, whole_words, stem) for keyword in keywords):
+        return local_only
+    terms = []
+    seen = set()
+    for keyword in keywords:
+        term = _query_term(keyword)
+        if term and term.lower() not in seen:
+            seen.add(term.lower())
+            terms.append(term)
+
+    if not terms:
+        return {'q': topic_query}
+
+    if ' ' in topic_query:
+        topic_query = f"({topic_query})"
+    query = f"{topic_query} AND ({' OR '.join(terms)})"
+    if len(query) <= max_length:
+        # Локальный фильтр смотрит только заголовок и описание - ищем там же
+        return {'q': query, 'searchIn': 'title,description'}
+    # Часть слов не влезает: сужение до оставшихся потеряло бы статьи с отброшенными словами
+    return local_only
+
+
+def pack_topic_queries(topic_queries: List[Tuple[Hashable, str]], max_topics: int = 5,
+                       max_length: int = NEWSAPI_MAX_QUERY_LENGTH) -> List[Tuple[List[Hashable], str]]:
+    """Упаковывает запросы тем в объединенные OR-запросы в пределах лимита длины
+
+    Принимает пары (ключ темы, q) и возвращает пары (ключи тем пакета, объединенный q).
+    Темы одного пакета должны иметь один язык: ключ темы - кортеж (тема, язык, ключевые слова).
+    """
+    batches: List[Tuple[List[Hashable], str]] = []
+    open_batches: Dict[Hashable, Tuple[List[Hashable], List[str]]] = {}
+
+    def close(language: Hashable) -> None:
+        keys, parts = open_batches.pop(language)
+        query = parts[0] if len(parts) == 1 else ' OR '.join(f"({part})" for part in parts)
+        batches.append((keys, query))
+
+    # Короткие запросы первыми - так в пакет помещается больше тем
+    for key, query in sorted(topic_queries, key=lambda item: len(item[1])):
+        language = key[1]
+        if language in open_batches:
+            keys, parts = open_batches[language]
+            combined_length = sum(len(part) + 2 for part in parts) + 4 * len(parts) + len(query) + 2
+            if len(keys) >= max_topics or combined_length > max_length:
+                close(language)
+        if language not in open_batches:
+            open_batches[language] = ([], [])
+        open_batches[language][0].append(key)
+        open_batches[language][1].append(query)
+
+    for language in list(open_batches):
+        close(language)
+    return batches
+
+
+def merge_articles(*article_lists: List[Dict]) -> List[Dict]:
+    """Объединяет статьи из нескольких источников без дублей по каноническому URL, новые первыми"""
+    merged: Dict = {}
+    for articles in article_lists:
+        for article in articles:
+            merged.setdefault(canonicalize_url(article.get('url') or '') or id(article), article)
+    return sorted(merged.values(), key=lambda article: article.get('publishedAt') or '', reverse=True)
+
+
+class NewsSource:
+    """Базовый класс источника новостей"""
+
+    name = 'base'
+
+    async def fetch(self, query: str, language: str, priority: str,
+                    extra_params: Optional[Dict] = None,
+                    keywords: Optional[List[str]] = None) -> List[Dict]:
+        """Возвращает статьи по запросу; ошибки источника не пробрасываются, кроме QuotaExceededError"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики источника"""
+        return {}
+
+
+class NewsApiSource(NewsSource):
+    """NewsAPI через NewsBot.get_news (кэши, квота и объединение запросов)"""
+
+    name = 'newsapi'
+
+    def __init__(self, get_news: Callable[..., Awaitable[List[Dict]]],
+                 whole_words: bool = False, stem: bool = False):
+        self._get_news = get_news
+        # Настройки локального фильтра: от них зависит, можно ли искать ключевые слова в NewsAPI
+        self.whole_words = whole_words
+        self.stem = stem
+
+    async def fetch(self, query: str, language: str, priority: str,
+                    extra_params: Optional[Dict] = None,
+                    keywords: Optional[List[str]] = None) -> List[Dict]:
+        # Ключевые слова фильтруются на стороне NewsAPI, страница результатов не тратится на лишние статьи
+        planned = plan_news_query(query, keywords, whole_words=self.whole_words, stem=self.stem)
+        params = {k: v for k, v in planned.items() if k != 'q'}
+        params.update(extra_params or {})
+        return await self._get_news(planned['q'], language, priority=priority, extra_params=params or None)
+
+
+def _local_name(tag: str) -> str:
+    """Имя тега без пространства имен"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _format_date(value: Optional[str]) -> str:
+    """Приводит дату RSS (RFC 822) или Atom (ISO 8601) к формату NewsAPI"""
+    if not value:
+        return ''
+    value = value.strip()
+    try:
+        date_obj = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        try:
+            date_obj = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return ''
+    if date_obj.tzinfo is None:
+        date_obj = date_obj.replace(tzinfo=timezone.utc)
+    return date_obj.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _html_to_text(value: str) -> str:
+    """Текст без тегов HTML и с раскрытыми сущностями (описания в лентах часто содержат HTML)"""
+    text = html.unescape(HTML_TAG_RE.sub(' ', value))
+    # Разметка, экранированная дважды (&lt;p&gt;), после раскрытия сущностей снова становится тегами
+    if '<' in text and '>' in text:
+        text = HTML_TAG_RE.sub(' ', text)
+    return ' '.join(text.split())
+
+
+class FeedParser:
+    """Потоковый разбор RSS/Atom: данные подаются блоками, элементы освобождаются сразу после разбора"""
+
+    ITEM_TAGS = ('item', 'entry')
+
+    def __init__(self, max_items: int = 200):
+        self.max_items = max_items
+        self.feed_title = ''
+        self.articles: List[Dict] = []
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._item_depth = 0
+
+    def feed(self, chunk: bytes) -> None:
+        """Разбирает очередной блок данных"""
+        self._parser.feed(chunk)
+        self._process_events()
+
+    def close(self) -> List[Dict]:
+        """Завершает разбор и возвращает статьи"""
+        self._parser.close()
+        self._process_events()
+        for article in self.articles:
+            article['source'] = {'id': None, 'name': self.feed_title}
+        return self.articles
+
+    def _process_events(self) -> None:
+        for event, elem in self._parser.read_events():
+            tag = _local_name(elem.tag)
+            if event == 'start':
+                if tag in self.ITEM_TAGS:
+                    self._item_depth += 1
+                continue
+
+            if tag in self.ITEM_TAGS:
+                self._item_depth -= 1
+                if len(self.articles) < self.max_items:
+                    article = self._parse_item(elem)
+                    if article['url']:
+                        self.articles.append(article)
+                elem.clear()
+            elif tag == 'title' and not self._item_depth and not self.feed_title:
+                self.feed_title = (elem.text or '').strip()
+
+    @staticmethod
+    def _parse_item(elem: ET.Element) -> Dict:
+        """Преобразует item (RSS) или entry (Atom) в статью формата NewsAPI"""
+        fields: Dict[str, str] = {}
+        link = ''
+        for child in elem:
+            tag = _local_name(child.tag)
+            if tag == 'link':
+                # В Atom ссылка в атрибуте href, в RSS - в тексте
+                href = child.get('href')
+                if href and child.get('rel', 'alternate') == 'alternate':
+                    link = href
+                elif not href and child.text:
+                    link = child.text.strip()
+            elif tag not in fields:
+                fields[tag] = (child.text or '').strip()
+
+        if not link and fields.get('guid', '').startswith('http'):
+            link = fields['guid']
+
+        return {
+            'title': _html_to_text(fields.get('title', '')),
+            'description': _html_to_text(
+                fields.get('description') or fields.get('summary') or fields.get('content', '')
+            ),
+            'url': link,
+            'publishedAt': _format_date(
+                fields.get('pubDate') or fields.get('published') or fields.get('updated') or fields.get('date')
+            )
+        }
+
+
+class RssSource(NewsSource):
+    """RSS/Atom ленты: условные GET запросы и фильтрация записей по запросу"""
+
+    name = 'rss'
+
+    def __init__(self, feeds: List[str], http: UpstreamClient, max_items: int = 200, stem: bool = False):
+        self.feeds = feeds
+        self.http = http
+        self.max_items = max_items
+        # Сравнивать слова запроса по основам, как локальный фильтр ключевых слов
+        self.stem = stem
+        # Состояние лент: ETag/Last-Modified (или mtime файла) и разобранные статьи
+        self._feed_state: Dict[str, Dict] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.not_modified = 0
+        self.downloaded = 0
+
+    @staticmethod
+    def _local_path(feed: str) -> Optional[str]:
+        """Путь к файлу для локальной ленты (file:// или путь на диске)"""
+        if feed.startswith('file://'):
+            return feed[len('file://'):]
+        if '://' not in feed:
+            return feed
+        return None
+
+    async def load_feed(self, feed: str) -> List[Dict]:
+        """Возвращает статьи ленты, перекачивая ее только при изменении"""
+        lock = self._locks.setdefault(feed, asyncio.Lock())
+        async with lock:
+            path = self._local_path(feed)
+            if path is not None:
+                return await self._load_file(feed, path)
+            return await self._load_url(feed)
+
+    async def _load_file(self, feed: str, path: str) -> List[Dict]:
+        """Читает локальную ленту, если файл изменился"""
+        state = self._feed_state.get(feed)
+        mtime = os.path.getmtime(path)
+        if state and state.get('mtime') == mtime:
+            self.not_modified += 1
+            return state['articles']
+
+        def parse() -> List[Dict]:
+            parser = FeedParser(self.max_items)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                    parser.feed(chunk)
+            return parser.close()
+
+        articles = await asyncio.to_thread(parse)
+        self._feed_state[feed] = {'mtime': mtime, 'articles': articles}
+        self.downloaded += 1
+        return articles
+
+    async def _load_url(self, feed: str) -> List[Dict]:
+        """Скачивает ленту условным GET и разбирает ее по мере получения"""
+        state = self._feed_state.get(feed, {})
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+
+        async with self.http.stream(feed, headers=headers) as response:
+            if response.status_code == 304 and 'articles' in state:
+                self.not_modified += 1
+                return state['articles']
+
+            parser = FeedParser(self.max_items)
+            async for chunk in response.aiter_bytes():
+                parser.feed(chunk)
+            articles = parser.close()
+
+            self._feed_state[feed] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'articles': articles
+            }
+        self.downloaded += 1
+        return articles
+
+    def _matches(self, article: Dict, query_words: List[str]) -> bool:
+        """Все слова запроса встречаются в заголовке или описании (после нормализации)"""
+        content = normalize_article_text(
+            f"{article.get('title') or ''} {article.get('description') or ''}", self.stem
+        )
+        return all(word in content for word in query_words)
+
+    async def fetch(self, query: str, language: str, priority: str,
+                    extra_params: Optional[Dict] = None,
+                    keywords: Optional[List[str]] = None) -> List[Dict]:
+        # Ключевые слова для лент проверяет локальный фильтр
+        results = await asyncio.gather(*(self.load_feed(feed) for feed in self.feeds), return_exceptions=True)
+
+        query_words = normalize_text(query, self.stem).split()
+        since = _format_date((extra_params or {}).get('from'))
+        articles = []
+        for feed, result in zip(self.feeds, results):
+            if isinstance(result, (UpstreamError, OSError, ET.ParseError)):
+                logger.error(f"Ошибка при загрузке ленты {feed}: {result}")
+                continue
+            if isinstance(result, BaseException):
+                logger.error(f"Неожиданная ошибка при загрузке ленты {feed}: {result}")
+                continue
+            articles.extend(
+                article for article in result
+                if self._matches(article, query_words) and (not since or article['publishedAt'] >= since)
+            )
+        return articles
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики загрузок лент"""
+        return {
+            'feeds': len(self.feeds),
+            'downloaded': self.downloaded,
+            'not_modified': self.not_modified
+        }
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Ранжирование статей по темам
+BM25 по словам темы и ключевым словам, затухание по возрасту и вес источника;
+оценки считаются матрицами NumPy сразу для всех статей и тем прогона
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from matching import WORD_RE, normalize_article_text, normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+def parse_source_weights(value: str) -> Dict[str, float]:
+    """Разбирает веса источников из строки вида "РБК=1.2,Lenta.ru=0.8" """
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.rpartition('=')
+        if not name.strip():
+            continue
+        try:
+            weights[name.strip().lower()] = float(weight)
+        except ValueError:
+            logger.warning(f"Некорректный вес источника: {item}")
+    return weights
+
+
+def _published_timestamp(article: Dict) -> Optional[float]:
+    """Время публикации статьи в секундах Unix"""
+    value = article.get('publishedAt')
+    if not value:
+        return None
+    try:
+        date_obj = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date_obj.tzinfo is None:
+        date_obj = date_obj.astimezone()
+    return date_obj.timestamp()
+
+
+class ArticleRanker:
+    """Сортирует статьи каждой темы по убыванию оценки релевантности
+
+    Оценка = ((1 - recency_weight) * BM25 / max BM25 темы + recency_weight * 0.5 ** (возраст / half_life))
+    * вес источника.
+    Ключ темы - кортеж (тема, язык, ключевые слова), как в NewsBot._topic_key.
+    """
+
+    def __init__(self, half_life_hours: float = 24, source_weights: Optional[Dict[str, float]] = None,
+                 recency_weight: float = 0.3, k1: float = 1.2, b: float = 0.75, stem: bool = True):
+        self.half_life = half_life_hours * 3600
+        self.recency_weight = recency_weight
+        self.source_weights = source_weights or {}
+        self.k1 = k1
+        self.b = b
+        self.stem = stem
+
+    def _query_terms(self, key: Tuple) -> List[str]:
+        """Слова запроса темы: слова названия и ключевых слов"""
+        text = ' '.join([key[0], *(keyword.strip('"') for keyword in key[2])])
+        return WORD_RE.findall(normalize_text(text, self.stem))
+
+    def rank(self, news_by_topic: Dict[Hashable, List[Dict]],
+             now: Optional[float] = None) -> Dict[Hashable, List[Dict]]:
+        """Возвращает статьи тем, отсортированные по оценке"""
+        documents: List[Dict] = []
+        positions: Dict[int, int] = {}
+        for articles in news_by_topic.values():
+            for article in articles:
+                if id(article) not in positions:
+                    positions[id(article)] = len(documents)
+                    documents.append(article)
+        if not documents:
+            return {key: list(articles) for key, articles in news_by_topic.items()}
+
+        # Словарь строится только из слов запросов: остальные слова в BM25 не участвуют
+        topic_keys = list(news_by_topic)
+        vocabulary: Dict[str, int] = {}
+        query = []
+        for key in topic_keys:
+            terms = self._query_terms(key)
+            query.append([vocabulary.setdefault(term, len(vocabulary)) for term in terms])
+
+        term_counts = np.zeros((len(documents), max(1, len(vocabulary))), dtype=np.float32)
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for row, article in enumerate(documents):
+            text = normalize_article_text(
+                f"{article.get('title') or ''} {article.get('description') or ''}", self.stem
+            )
+            words = WORD_RE.findall(text)
+            lengths[row] = len(words)
+            for word in words:
+                column = vocabulary.get(word)
+                if column is not None:
+                    term_counts[row, column] += 1
+
+        # BM25 для всех пар (статья, слово) одной матричной операцией
+        document_frequency = (term_counts > 0).sum(axis=0)
+        idf = np.log1p((len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        average_length = max(float(lengths.mean()), 1.0)
+        norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+        bm25 = term_counts * (self.k1 + 1) / (term_counts + norm[:, None]) * idf
+
+        # Матрица запросов: столбец темы - вхождения слов ее запроса
+        query_matrix = np.zeros((bm25.shape[1], len(topic_keys)), dtype=np.float32)
+        for column, terms in enumerate(query):
+            for term in terms:
+                query_matrix[term, column] += 1
+        relevance = bm25 @ query_matrix
+
+        now = now if now is not None else datetime.now(timezone.utc).timestamp()
+        published = np.array([
+            _published_timestamp(article) or now - self.half_life for article in documents
+        ], dtype=np.float64)
+        age = np.clip(now - published, 0, None)
+        decay = np.power(0.5, age / self.half_life) if self.half_life > 0 else np.ones(len(documents))
+        source_weight = np.array([
+            self.source_weights.get(((article.get('source') or {}).get('name') or '').lower(), 1.0)
+            for article in documents
+        ])
+
+        ranked = {}
+        for column, key in enumerate(topic_keys):
+            rows = np.array([positions[id(article)] for article in news_by_topic[key]], dtype=np.int64)
+            if not len(rows):
+                ranked[key] = []
+                continue
+            # Релевантность нормируется внутри темы, чтобы ее вес не зависел от длины запроса
+            topic_relevance = relevance[rows, column]
+            top = float(topic_relevance.max())
+            if top > 0:
+                topic_relevance = topic_relevance / top
+            scores = ((1 - self.recency_weight) * topic_relevance
+                      + self.recency_weight * decay[rows]) * source_weight[rows]
+            # Устойчивая сортировка: при равной оценке сохраняется исходный порядок (новые первыми)
+            order = np.argsort(-scores, kind='stable')
+            ranked[key] = [news_by_topic[key][index] for index in order]
+        return ranked
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Ограничение частоты запросов: token bucket и дневная квота NewsAPI
+с приоритетом интерактивных запросов над фоновыми
+"""
+
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BACKGROUND = 'background'
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self) -> None:
+        """Пополняет запас токенов за прошедшее время"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until_available(self, tokens: float = 1) -> float:
+        """Через сколько секунд будет доступно нужное число токенов"""
+        self._refill()
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self, tokens: float = 1, max_wait: Optional[float] = None) -> bool:
+        """Ждет токены не дольше max_wait секунд; False, если дождаться не удалось"""
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = self.time_until_available(tokens)
+            if wait <= 0:
+                self.tokens -= tokens
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов (например, по Retry-After)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class QuotaManager:
+    """Учет дневной квоты и частоты запросов к API"""
+
+    def __init__(self, daily_limit: int = 100, per_second: float = 1.0,
+                 background_reserve: int = 20, window_seconds: float = 86400,
+                 default_retry_after: float = 60):
+        self.daily_limit = daily_limit
+        # Часть квоты, которую фоновые задачи не расходуют: она остается для команд пользователей
+        self.background_reserve = background_reserve
+        self.window_seconds = window_seconds
+        self.default_retry_after = default_retry_after
+        self.bucket = TokenBucket(per_second)
+        self.window_started = time.time()
+        self.used = 0
+        self.blocked_until = 0.0
+        self.granted = 0
+        self.denied = 0
+        self.rate_limited = 0
+
+    def _roll_window(self) -> None:
+        """Начинает новое окно квоты, если текущее истекло"""
+        now = time.time()
+        if now - self.window_started >= self.window_seconds:
+            self.window_started = now
+            self.used = 0
+
+    def remaining(self) -> int:
+        """Сколько запросов осталось в текущем окне"""
+        self._roll_window()
+        return max(0, self.daily_limit - self.used)
+
+    def can_spend(self, priority: str = PRIORITY_INTERACTIVE) -> bool:
+        """Есть ли бюджет для запроса с указанным приоритетом"""
+        if time.time() < self.blocked_until:
+            return False
+        reserve = self.background_reserve if priority == PRIORITY_BACKGROUND else 0
+        return self.remaining() > reserve
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE) -> bool:
+        """Резервирует один запрос; False - бюджет исчерпан или API просит подождать"""
+        if not self.can_spend(priority):
+            self.denied += 1
+            return False
+
+        # Команды пользователя ждут недолго, фоновая рассылка может подождать дольше
+        max_wait = 2.0 if priority == PRIORITY_INTERACTIVE else 60.0
+        if not await self.bucket.acquire(max_wait=max_wait) or not self.can_spend(priority):
+            self.denied += 1
+            return False
+
+        self.used += 1
+        self.granted += 1
+        return True
+
+    def state(self) -> Dict[str, float]:
+        """Состояние окна квоты для сохранения между перезапусками"""
+        return {
+            'window_started': self.window_started,
+            'used': self.used,
+            'blocked_until': self.blocked_until
+        }
+
+    def restore(self, state: Dict[str, float]) -> None:
+        """Восстанавливает окно квоты, сохраненное до перезапуска"""
+        self.window_started = float(state.get('window_started', self.window_started))
+        self.used = int(state.get('used', 0))
+        self.blocked_until = float(state.get('blocked_until', 0.0))
+        self._roll_window()
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """Обрабатывает ответ 429: блокирует запросы на время Retry-After"""
+        delay = retry_after if retry_after is not None else self.default_retry_after
+        self.blocked_until = max(self.blocked_until, time.time() + delay)
+        self.bucket.pause(delay)
+        self.rate_limited += 1
+        logger.warning(f"API ограничило частоту запросов, пауза {delay:.0f} сек")
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики квоты"""
+        return {
+            'remaining': self.remaining(),
+            'used': self.used,
+            'granted': self.granted,
+            'denied': self.denied,
+            'rate_limited': self.rate_limited
+        }
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Планировщик ежедневных дайджестов по пользователям
+Каждый пользователь получает дайджест в свое время и в своем часовом поясе;
+ближайшие отправки хранятся в куче, рассылка идет небольшими пачками в течение дня
+"""
+
+import time
+import heapq
+import zlib
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Dict, List, Optional, Tuple
+
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+def parse_digest_time(value: str) -> Tuple[int, int]:
+    """Разбирает время "ЧЧ:ММ"; ValueError при неверном формате"""
+    parsed = datetime.strptime(value.strip(), "%H:%M")
+    return parsed.hour, parsed.minute
+
+
+def get_timezone(name: Optional[str]) -> Optional[tzinfo]:
+    """Часовой пояс по имени IANA (Europe/Moscow) или None, если имя неизвестно"""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+class DigestScheduler:
+    """Куча ближайших отправок дайджеста: (время отправки, пользователь)
+
+    Пользователи без своего времени получают дайджест в default_time со сдвигом
+    в пределах spread_minutes, чтобы рассылка не приходилась на одну минуту.
+    """
+
+    def __init__(self, default_time: str = '09:00', default_timezone: Optional[str] = None,
+                 spread_minutes: int = 0):
+        self.default_time = parse_digest_time(default_time)
+        # Без явного пояса используется локальное время сервера (как раньше у run_daily)
+        self.default_timezone = get_timezone(default_timezone) or datetime.now().astimezone().tzinfo
+        self.spread_seconds = spread_minutes * 60
+        self._heap: List[Tuple[float, int]] = []
+        # Актуальное время отправки пользователя; записи кучи с другим временем устарели
+        self._due: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def next_run(self, user_id: int, digest_time: Optional[str] = None,
+                 timezone_name: Optional[str] = None, after: Optional[float] = None) -> float:
+        """Ближайшее время отправки (Unix time) строго после after"""
+        after = after if after is not None else time.time()
+        tz = get_timezone(timezone_name) or self.default_timezone
+        offset = 0
+        try:
+            hour, minute = parse_digest_time(digest_time) if digest_time else self.default_time
+        except ValueError:
+            hour, minute = self.default_time
+            digest_time = None
+        if not digest_time and self.spread_seconds:
+            # Стабильный сдвиг пользователя внутри окна рассылки
+            offset = zlib.crc32(str(user_id).encode()) % self.spread_seconds
+
+        local_day = datetime.fromtimestamp(after, tz).date()
+        for days in range(3):
+            day = local_day + timedelta(days=days)
+            run_at = self._local_timestamp(day, hour, minute, tz) + offset
+            if run_at > after:
+                return run_at
+        return after + 86400
+
+    @staticmethod
+    def _local_timestamp(day: date, hour: int, minute: int, tz: tzinfo) -> float:
+        """Unix time для локального времени дня в часовом поясе"""
+        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=tz).astimezone(timezone.utc).timestamp()
+
+    def schedule(self, user_id: int, digest_time: Optional[str] = None,
+                 timezone_name: Optional[str] = None, after: Optional[float] = None) -> float:
+        """Планирует (или переносит) ближайшую отправку пользователю"""
+        run_at = self.next_run(user_id, digest_time, timezone_name, after)
+        self._due[user_id] = run_at
+        heapq.heappush(self._heap, (run_at, user_id))
+        # Перенесенные и отмененные отправки оставляют устаревшие записи - периодически пересобираем кучу
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, uid) for uid, due in self._due.items()]
+            heapq.heapify(self._heap)
+        return run_at
+
+    def cancel(self, user_id: int) -> None:
+        """Отменяет отправки пользователю (запись в куче удаляется при извлечении)"""
+        self._due.pop(user_id, None)
+
+    def scheduled_at(self, user_id: int) -> Optional[float]:
+        """Запланированное время отправки пользователю"""
+        return self._due.get(user_id)
+
+    def pop_due(self, now: Optional[float] = None, limit: int = 0) -> List[int]:
+        """Извлекает пользователей, чье время наступило (не больше limit, 0 - без ограничения)"""
+        now = now if now is not None else time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and (not limit or len(due) < limit):
+            run_at, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) != run_at:
+                continue
+            del self._due[user_id]
+            due.append(user_id)
+        return due
+
+    def due_within(self, seconds: float, now: Optional[float] = None) -> List[int]:
+        """Пользователи, которым дайджест будет отправлен в ближайшие seconds секунд"""
+        border = (now if now is not None else time.time()) + seconds
+        return [user_id for user_id, run_at in self._due.items() if run_at <= border]
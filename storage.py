@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Хранилища данных пользователей для Telegram News Bot
+JSON-файл (исходный формат), журнал изменений со снимками,
+SQLite с построчными обновлениями и отложенная (write-behind) запись
+"""
+
+import os
+import sys
+import copy
+import json
+import asyncio
+import sqlite3
+import logging
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Поля записи пользователя и темы, которые хранятся в отдельных колонках/таблицах
+USER_FIELDS = ('topics', 'keywords', 'daily_digest', 'last_digest')
+TOPIC_FIELDS = ('name', 'keywords', 'added_at')
+
+
+def atomic_write_json(path: str, data: Dict) -> None:
+    """Записывает JSON через временный файл, fsync и атомарное переименование"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Синхронизируем каталог, чтобы переименование пережило сбой питания
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def persistent_copy(user_data: Dict) -> Dict:
+    """Копия записи пользователя без служебных полей (с префиксом _) у пользователя и его тем"""
+    record = {}
+    for key, value in user_data.items():
+        if key.startswith('_'):
+            continue
+        if key == 'topics':
+            value = [{k: v for k, v in topic.items() if not k.startswith('_')} for topic in value]
+        record[key] = copy.deepcopy(value)
+    return record
+
+
+def normalize_user_id(user_id):
+    """Приводит ключ пользователя к int (JSON хранит ключи строками)"""
+    if isinstance(user_id, str) and user_id.lstrip('-').isdigit():
+        return int(user_id)
+    return user_id
+
+
+class UserStore:
+    """Базовый класс хранилища данных пользователей"""
+
+    def load(self) -> Dict:
+        """Загружает данные всех пользователей"""
+        raise NotImplementedError
+
+    def save_users(self, records: Dict) -> None:
+        """Сохраняет записи указанных пользователей (None - удалить пользователя)"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Освобождает ресурсы хранилища"""
+
+
+class JsonUserStore(UserStore):
+    """Хранилище в одном JSON файле (файл перезаписывается целиком)"""
+
+    def __init__(self, data_file: str = 'news_data.json'):
+        self.data_file = data_file
+        self._data: Dict = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict:
+        """Загружает данные пользователей из JSON файла"""
+        try:
+            self._read_data()
+            if self._data:
+                logger.info(f"Загружены данные для {len(self._data)} пользователей")
+            else:
+                logger.info("Файл данных не найден или пуст, создаем новый")
+            return copy.deepcopy(self._data)
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка парсинга JSON: {e}")
+            # Создаем резервную копию поврежденного файла
+            if os.path.exists(self.data_file):
+                backup_file = f"{self.data_file}.backup"
+                os.rename(self.data_file, backup_file)
+                logger.info(f"Создана резервная копия: {backup_file}")
+            return {}
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке данных: {e}")
+            return {}
+
+    def _read_data(self) -> None:
+        """Читает JSON файл в self._data"""
+        self._data = {}
+        if os.path.exists(self.data_file):
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._data = {normalize_user_id(k): v for k, v in data.items()}
+
+    def _apply(self, records: Dict) -> None:
+        """Применяет записи к данным в памяти"""
+        for user_id, user_data in records.items():
+            if user_data is None:
+                self._data.pop(user_id, None)
+            else:
+                self._data[user_id] = persistent_copy(user_data)
+
+    def save_users(self, records: Dict) -> None:
+        """Обновляет записи и перезаписывает JSON файл"""
+        with self._lock:
+            self._apply(records)
+            atomic_write_json(self.data_file, self._data)
+
+
+class JournalUserStore(JsonUserStore):
+    """Снимок в JSON файле плюс журнал изменений: каждое изменение дописывается одной строкой"""
+
+    def __init__(self, data_file: str = 'news_data.json', compact_records: int = 10000):
+        super().__init__(data_file)
+        self.journal_file = f"{data_file}.journal"
+        self.compact_records = compact_records
+        self._journal = None
+        self._journal_records = 0
+
+    def _read_data(self) -> None:
+        """Читает снимок и воспроизводит поверх него журнал"""
+        super()._read_data()
+        self._journal_records = 0
+        if not os.path.exists(self.journal_file):
+            return
+
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная последняя строка после аварийной остановки
+                    logger.warning(f"Пропущена поврежденная запись журнала (строка {line_number})")
+                    continue
+                self._apply({normalize_user_id(entry['u']): entry.get('d')})
+                self._journal_records += 1
+
+        if self._journal_records:
+            logger.info(f"Воспроизведено {self._journal_records} записей журнала")
+
+    def save_users(self, records: Dict) -> None:
+        """Дописывает изменения в журнал, при росте журнала обновляет снимок"""
+        with self._lock:
+            self._apply(records)
+            if self._journal is None:
+                self._open_journal()
+            for user_id, user_data in records.items():
+                self._journal.write(json.dumps({'u': user_id, 'd': user_data}, ensure_ascii=False, separators=(',', ':')))
+                self._journal.write('\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_records += len(records)
+
+            if self._journal_records >= self.compact_records:
+                self._compact()
+
+    def _open_journal(self) -> None:
+        """Открывает журнал на дозапись, отделяя недописанную строку"""
+        torn = False
+        if os.path.exists(self.journal_file) and os.path.getsize(self.journal_file) > 0:
+            with open(self.journal_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b'\n'
+        self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        if torn:
+            self._journal.write('\n')
+
+    def _compact(self) -> None:
+        """Сжатие журнала (вызывается под блокировкой)"""
+        # Сначала атомарно пишем снимок: записи журнала идемпотентны,
+        # поэтому сбой до очистки журнала не приводит к потере данных
+        atomic_write_json(self.data_file, self._data)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_file, 'w', encoding='utf-8')
+        os.fsync(self._journal.fileno())
+        logger.info(f"Журнал сжат: {self._journal_records} записей перенесено в снимок ({len(self._data)} пользователей)")
+        self._journal_records = 0
+
+    def close(self) -> None:
+        """Закрывает файл журнала"""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class SqliteUserStore(UserStore):
+    """Хранилище в SQLite: пользователи, темы и ключевые слова в отдельных таблицах"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            daily_digest INTEGER NOT NULL DEFAULT 1,
+            last_digest TEXT,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            added_at TEXT,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_topics_user ON topics(user_id);
+        CREATE TABLE IF NOT EXISTS keywords (
+            user_id INTEGER NOT NULL,
+            topic_id INTEGER,
+            position INTEGER NOT NULL,
+            keyword TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_keywords_user ON keywords(user_id);
+        CREATE INDEX IF NOT EXISTS idx_keywords_topic ON keywords(topic_id);
+    """
+
+    def __init__(self, db_file: str = 'news_data.db'):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        # Запись может выполняться из фонового потока
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def is_empty(self) -> bool:
+        """Проверяет, есть ли в базе пользователи"""
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM users LIMIT 1').fetchone()
+        return row is None
+
+    def load(self) -> Dict:
+        """Загружает данные пользователей из базы"""
+        with self._lock:
+            users_rows = self._conn.execute(
+                'SELECT user_id, daily_digest, last_digest, extra FROM users'
+            ).fetchall()
+            topic_rows = self._conn.execute(
+                'SELECT id, user_id, name, added_at, extra FROM topics ORDER BY user_id, position'
+            ).fetchall()
+            keyword_rows = self._conn.execute(
+                'SELECT user_id, topic_id, keyword FROM keywords ORDER BY user_id, topic_id, position'
+            ).fetchall()
+
+        data: Dict = {}
+        for user_id, daily_digest, last_digest, extra in users_rows:
+            user_data = json.loads(extra) if extra else {}
+            user_data.update({
+                'topics': [],
+                'keywords': [],
+                'daily_digest': bool(daily_digest),
+                'last_digest': last_digest
+            })
+            data[user_id] = user_data
+
+        topics_by_id: Dict[int, Dict] = {}
+        for topic_id, user_id, name, added_at, extra in topic_rows:
+            if user_id not in data:
+                continue
+            topic = json.loads(extra) if extra else {}
+            topic.update({'name': name, 'keywords': [], 'added_at': added_at})
+            topics_by_id[topic_id] = topic
+            data[user_id]['topics'].append(topic)
+
+        for user_id, topic_id, keyword in keyword_rows:
+            if topic_id is None:
+                if user_id in data:
+                    data[user_id]['keywords'].append(keyword)
+            elif topic_id in topics_by_id:
+                topics_by_id[topic_id]['keywords'].append(keyword)
+
+        logger.info(f"Загружены данные для {len(data)} пользователей из {self.db_file}")
+        return data
+
+    def save_users(self, records: Dict) -> None:
+        """Построчно обновляет записи указанных пользователей в одной транзакции"""
+        with self._lock, self._conn:
+            for user_id, user_data in records.items():
+                self._delete_user_rows(user_id)
+                if user_data is not None:
+                    self._insert_user_rows(user_id, user_data)
+
+    def _delete_user_rows(self, user_id: int) -> None:
+        """Удаляет строки пользователя из всех таблиц"""
+        self._conn.execute('DELETE FROM keywords WHERE user_id = ?', (user_id,))
+        self._conn.execute('DELETE FROM topics WHERE user_id = ?', (user_id,))
+        self._conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+    def _insert_user_rows(self, user_id: int, user_data: Dict) -> None:
+        """Записывает пользователя, его темы и ключевые слова"""
+        self._conn.execute(
+            'INSERT INTO users (user_id, daily_digest, last_digest, extra) VALUES (?, ?, ?, ?)',
+            (
+                user_id,
+                int(bool(user_data.get('daily_digest', True))),
+                user_data.get('last_digest'),
+                self._dump_extra(user_data, USER_FIELDS)
+            )
+        )
+        self._insert_keywords(user_id, None, user_data.get('keywords', []))
+
+        for position, topic in enumerate(user_data.get('topics', [])):
+            cursor = self._conn.execute(
+                'INSERT INTO topics (user_id, position, name, added_at, extra) VALUES (?, ?, ?, ?, ?)',
+                (
+                    user_id,
+                    position,
+                    topic['name'],
+                    topic.get('added_at'),
+                    self._dump_extra(topic, TOPIC_FIELDS)
+                )
+            )
+            self._insert_keywords(user_id, cursor.lastrowid, topic.get('keywords', []))
+
+    def _insert_keywords(self, user_id: int, topic_id: Optional[int], keywords: List[str]) -> None:
+        """Записывает ключевые слова пользователя или темы"""
+        self._conn.executemany(
+            'INSERT INTO keywords (user_id, topic_id, position, keyword) VALUES (?, ?, ?, ?)',
+            [(user_id, topic_id, position, keyword) for position, keyword in enumerate(keywords)]
+        )
+
+    @staticmethod
+    def _dump_extra(record: Dict, known_fields) -> Optional[str]:
+        """Сериализует поля записи, для которых нет отдельных колонок"""
+        extra = {k: v for k, v in record.items() if k not in known_fields}
+        return json.dumps(extra, ensure_ascii=False) if extra else None
+
+    def close(self) -> None:
+        """Закрывает соединение с базой"""
+        with self._lock:
+            self._conn.close()
+
+
+class WriteBehindWriter:
+    """Отложенная запись: изменения помечаются, фоновая задача сбрасывает их пачкой"""
+
+    def __init__(self, store: UserStore, users_data: Dict, flush_interval_ms: int = 500):
+        self.store = store
+        self.users_data = users_data
+        self.flush_interval = flush_interval_ms / 1000
+        self._dirty: Set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._pending: Optional[asyncio.Task] = None
+        self.flushes = 0
+
+    def mark_dirty(self, user_id) -> None:
+        """Помечает пользователя для записи при ближайшем сбросе"""
+        self._dirty.add(user_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _take_snapshot(self) -> Dict:
+        """Забирает копии помеченных записей (вызывается в потоке event loop)"""
+        dirty, self._dirty = self._dirty, set()
+        return {
+            user_id: persistent_copy(self.users_data[user_id]) if user_id in self.users_data else None
+            for user_id in dirty
+        }
+
+    async def start(self) -> None:
+        """Запускает фоновую задачу сброса"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        if self._dirty:
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Отложенная запись включена (интервал {int(self.flush_interval * 1000)} мс)")
+
+    async def _run(self) -> None:
+        """Сбрасывает изменения не чаще одного раза за интервал"""
+        while True:
+            await self._wakeup.wait()
+            # Даем накопиться изменениям, чтобы записать их одной операцией
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения вне event loop"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            # Запись в потоке не прерывается отменой: stop() дожидается ее перед финальным сбросом
+            self._pending = asyncio.create_task(self._save(self._take_snapshot()))
+            await asyncio.shield(self._pending)
+
+    async def _save(self, records: Dict) -> None:
+        """Записывает снимок записей в отдельном потоке"""
+        try:
+            await asyncio.to_thread(self.store.save_users, records)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных: {e}")
+            # Возвращаем записи в очередь, чтобы повторить при следующем сбросе
+            self._dirty.update(records.keys())
+
+    def flush_sync(self) -> None:
+        """Синхронно записывает все накопленные изменения"""
+        if not self._dirty:
+            return
+        records = self._take_snapshot()
+        try:
+            self.store.save_users(records)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных: {e}")
+            self._dirty.update(records.keys())
+
+    async def stop(self) -> None:
+        """Останавливает фоновую задачу и сбрасывает оставшиеся изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Дожидаемся записи, которая могла выполняться в момент отмены, иначе она
+        # перезапишет более новые данные финального сброса
+        if self._pending is not None:
+            await self._pending
+            self._pending = None
+        if self._flush_lock is not None:
+            async with self._flush_lock:
+                self.flush_sync()
+        else:
+            self.flush_sync()
+
+
+def import_json_to_sqlite(json_file: str, store: SqliteUserStore) -> int:
+    """Однократно переносит пользователей из JSON файла в SQLite"""
+    with open(json_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    records = {normalize_user_id(k): v for k, v in data.items()}
+    store.save_users(records)
+
+    # Переименовываем файл, чтобы импорт не повторялся при следующем запуске
+    imported_file = f"{json_file}.imported"
+    os.replace(json_file, imported_file)
+    logger.info(f"Импортировано {len(records)} пользователей из {json_file} (файл переименован в {imported_file})")
+    return len(records)
+
+
+def create_user_store() -> UserStore:
+    """Создает хранилище по переменной окружения STORAGE_BACKEND (json, journal или sqlite)"""
+    backend = os.getenv('STORAGE_BACKEND', 'json').lower()
+    data_file = os.getenv('DATA_FILE', 'news_data.json')
+
+    if backend == 'sqlite':
+        store = SqliteUserStore(os.getenv('DATABASE_FILE', 'news_data.db'))
+        if store.is_empty() and os.path.exists(data_file):
+            try:
+                import_json_to_sqlite(data_file, store)
+            except Exception as e:
+                logger.error(f"Ошибка при импорте данных из {data_file}: {e}")
+        return store
+
+    if backend == 'journal':
+        return JournalUserStore(data_file, int(os.getenv('JOURNAL_COMPACT_RECORDS', '10000')))
+
+    if backend != 'json':
+        logger.warning(f"Неизвестное хранилище '{backend}', используем JSON")
+    return JsonUserStore(data_file)
+
+
+if __name__ == '__main__':
+    # Ручной импорт: python storage.py [news_data.json] [news_data.db]
+    logging.basicConfig(level=logging.INFO)
+    source = sys.argv[1] if len(sys.argv) > 1 else 'news_data.json'
+    target = sys.argv[2] if len(sys.argv) > 2 else 'news_data.db'
+
+    if not os.path.exists(source):
+        print(f"Файл {source} не найден")
+        sys.exit(1)
+
+    count = import_json_to_sqlite(source, SqliteUserStore(target))
+    print(f"Готово: импортировано пользователей - {count}")
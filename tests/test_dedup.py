@@ -0,0 +1,217 @@
+import itertools
+
+import pytest
+
+from dedup import DEFAULT_MAX_DISTANCE, ArticleDeduplicator, canonicalize_url, hamming_distance, simhash
+
+# Одна новость в разных изданиях: (заголовок, описание) первого и второго издания
+SAME_STORY = [
+    (
+        'ЦБ сохранил ключевую ставку на уровне 21%',
+        'Банк России на заседании в пятницу оставил ключевую ставку без изменений, сообщил регулятор.',
+        'ЦБ сохранил ключевую ставку на уровне 21%',
+        'Банк России в пятницу оставил ключевую ставку неизменной, говорится в сообщении регулятора.'
+    ),
+    (
+        'Банк России сохранил ключевую ставку на уровне 21%',
+        'Совет директоров ЦБ принял решение оставить ставку без изменений.',
+        'ЦБ оставил ключевую ставку на уровне 21%',
+        'Совет директоров Банка России решил оставить ставку без изменений.'
+    ),
+    (
+        'OpenAI представила новую модель GPT-5',
+        'Компания OpenAI представила новую языковую модель, которая превосходит предыдущие версии в задачах программирования.',
+        'OpenAI показала новую модель GPT-5',
+        'OpenAI представила новую языковую модель, превосходящую прошлые версии в задачах программирования.'
+    ),
+    (
+        'В Москве выпал первый снег',
+        'Первый снег этой осени выпал в столице в ночь на понедельник, сообщают синоптики.',
+        'В Москве выпал первый снег',
+        'Синоптики сообщают, что первый в эту осень снег выпал в столице в ночь на понедельник.'
+    ),
+    (
+        'Apple представила iPhone 16',
+        'На презентации в Купертино компания показала новые смартфоны и часы.',
+        'Apple представила новый iPhone 16',
+        'Компания показала новые смартфоны и часы на презентации в Купертино.'
+    ),
+    (
+        'Курс доллара упал ниже 90 рублей',
+        'На Московской бирже курс доллара впервые с лета опустился ниже 90 рублей.',
+        'Курс доллара опустился ниже 90 рублей',
+        'Курс доллара на Московской бирже впервые с лета упал ниже 90 рублей.'
+    ),
+    (
+        'Сборная России по хоккею обыграла Финляндию',
+        'Встреча завершилась со счетом 4:2 в пользу российской команды.',
+        'Сборная России по хоккею победила Финляндию',
+        'Матч завершился со счетом 4:2 в пользу команды России.'
+    ),
+    (
+        'Нейросети научились распознавать рак по снимкам',
+        'Исследователи обучили модель находить опухоли на рентгеновских снимках с точностью 95%.',
+        'Нейросеть научилась распознавать рак по снимкам',
+        'Ученые обучили модель находить опухоли на рентгеновских снимках с точностью 95 процентов.'
+    ),
+    (
+        'Tesla отзывает 200 тысяч автомобилей',
+        'Причиной отзыва стала неисправность камеры заднего вида.',
+        'Tesla отзовет 200 тысяч автомобилей',
+        'Причина отзыва - неисправность камеры заднего вида, сообщает компания.'
+    ),
+    (
+        'Путин провел телефонный разговор с Си Цзиньпином',
+        'Лидеры обсудили двустороннее сотрудничество и международную повестку.',
+        'Путин провел телефонный разговор с председателем КНР Си Цзиньпином',
+        'Лидеры двух стран обсудили сотрудничество и международную повестку.'
+    ),
+    (
+        'Яндекс запустил беспилотные такси в Москве',
+        'Первые поездки на беспилотных автомобилях доступны жителям района Ясенево.',
+        'Яндекс запустил беспилотное такси в Москве',
+        'Жителям Ясенево доступны первые поездки на беспилотных автомобилях.'
+    ),
+    (
+        'Минфин предложил повысить НДС до 22%',
+        'Соответствующие поправки внесены в Налоговый кодекс.',
+        'Минфин предлагает повысить НДС до 22%',
+        'Поправки внесены в Налоговый кодекс, сообщает министерство.'
+    ),
+]
+
+# Разные новости одной темы
+DIFFERENT_STORIES = [
+    (
+        'ЦБ сохранил ключевую ставку на уровне 21%',
+        'Банк России на заседании в пятницу оставил ключевую ставку без изменений.',
+        'ЦБ повысил ключевую ставку до 23%',
+        'Банк России неожиданно повысил ставку на два процентных пункта.'
+    ),
+    (
+        'OpenAI представила новую модель GPT-5',
+        'Компания OpenAI представила новую языковую модель.',
+        'Google представила модель Gemini 2',
+        'Google показала новую версию своей языковой модели.'
+    ),
+    (
+        'В Москве выпал первый снег',
+        'Первый снег выпал в столице в ночь на понедельник.',
+        'В Петербурге ожидается сильный ветер',
+        'Синоптики предупредили о порывах ветра до 20 метров в секунду.'
+    ),
+    (
+        'Курс доллара упал ниже 90 рублей',
+        'Курс доллара на бирже опустился ниже 90 рублей.',
+        'Курс евро вырос выше 100 рублей',
+        'Курс евро на бирже поднялся выше 100 рублей впервые с весны.'
+    ),
+    (
+        'Сборная России по хоккею обыграла Финляндию',
+        'Встреча завершилась со счетом 4:2.',
+        'Сборная России по футболу проиграла Сербии',
+        'Матч завершился со счетом 0:1.'
+    ),
+    (
+        'Нейросети научились распознавать рак по снимкам',
+        'Модель находит опухоли на снимках.',
+        'Нейросети научились писать музыку',
+        'Новая модель сочиняет мелодии в разных жанрах.'
+    ),
+    (
+        'Tesla отзывает 200 тысяч автомобилей',
+        'Причиной стала неисправность камеры.',
+        'Tesla снизила цены на Model 3',
+        'Компания снизила стоимость седана на 10%.'
+    ),
+    (
+        'Apple представила iPhone 16',
+        'Компания показала новые смартфоны.',
+        'Samsung представила Galaxy S25',
+        'Компания показала новые флагманские смартфоны.'
+    ),
+    (
+        'Минфин предложил повысить НДС до 22%',
+        'Поправки внесены в Налоговый кодекс.',
+        'Минфин предложил снизить налог на прибыль',
+        'Поправки касаются малого бизнеса.'
+    ),
+    (
+        'Яндекс запустил беспилотные такси в Москве',
+        'Поездки доступны в Ясенево.',
+        'Яндекс запустил нейросеть для поиска',
+        'Новая модель отвечает на вопросы пользователей.'
+    ),
+]
+
+
+def article(title, description, url=''):
+    return {'title': title, 'description': description, 'url': url}
+
+
+def distance(first_title, first_description, second_title, second_description):
+    return hamming_distance(simhash(f"{first_title} {first_description}"),
+                            simhash(f"{second_title} {second_description}"))
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.example.com/news/1/?utm_source=tg&utm_medium=social', 'example.com/news/1'),
+    ('http://m.example.com/news/1#comments', 'example.com/news/1'),
+    ('https://example.com/amp/news/1', 'example.com/news/1'),
+    ('https://example.com/news/1.amp.html', 'example.com/news/1.html'),
+    ('https://example-com.cdn.ampproject.org/c/s/example.com/news/1', 'example.com/news/1'),
+    ('https://example.com/search?q=1&fbclid=x&page=2', 'example.com/search?page=2&q=1'),
+])
+def test_canonical_url(url, expected):
+    assert canonicalize_url(url) == expected
+
+
+@pytest.mark.parametrize('pair', SAME_STORY)
+def test_same_story_from_different_outlets_is_within_default_distance(pair):
+    assert distance(*pair) <= DEFAULT_MAX_DISTANCE
+
+
+@pytest.mark.parametrize('pair', DIFFERENT_STORIES)
+def test_different_stories_are_beyond_default_distance(pair):
+    assert distance(*pair) > DEFAULT_MAX_DISTANCE
+
+
+def test_unrelated_stories_do_not_collide():
+    stories = [(index, pair[:2]) for index, pair in enumerate(SAME_STORY)]
+    stories += [(index, pair[2:]) for index, pair in enumerate(SAME_STORY)]
+    for (first_index, first), (second_index, second) in itertools.combinations(stories, 2):
+        if first_index != second_index:
+            assert distance(*first, *second) > DEFAULT_MAX_DISTANCE, (first[0], second[0])
+
+
+def test_deduplicator_keeps_one_article_per_story():
+    deduplicator = ArticleDeduplicator()
+    articles = []
+    for index, (first_title, first_description, second_title, second_description) in enumerate(SAME_STORY):
+        articles.append(article(first_title, first_description, f'https://a.example/{index}'))
+        articles.append(article(second_title, second_description, f'https://b.example/{index}'))
+
+    unique = [item for item in articles if not deduplicator.is_duplicate(item)]
+
+    assert [item['url'] for item in unique] == [f'https://a.example/{index}' for index in range(len(SAME_STORY))]
+    assert deduplicator.duplicates == len(SAME_STORY)
+
+
+def test_same_canonical_url_is_a_duplicate_regardless_of_text():
+    deduplicator = ArticleDeduplicator(max_distance=0)
+
+    assert not deduplicator.is_duplicate(article('Первый текст', '', 'https://example.com/news/1'))
+    assert deduplicator.is_duplicate(article('Совсем другой текст', '', 'https://www.example.com/news/1?utm_source=x'))
+
+
+@pytest.mark.parametrize('max_distance', [0, 3, DEFAULT_MAX_DISTANCE])
+def test_band_lookup_matches_pairwise_comparison(max_distance):
+    texts = [f"{title} {description}" for pair in SAME_STORY + DIFFERENT_STORIES
+             for title, description in (pair[:2], pair[2:])]
+    deduplicator = ArticleDeduplicator(max_distance)
+    accepted = []
+    for text in texts:
+        expected = any(hamming_distance(simhash(text), simhash(other)) <= max_distance for other in accepted)
+        assert deduplicator.is_duplicate({'title': text}) == expected
+        if not expected:
+            accepted.append(text)
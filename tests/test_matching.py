@@ -0,0 +1,93 @@
+import pytest
+
+from matching import KeywordMatcher, SubscriptionIndex, compile_keywords, normalize_text, snowballstemmer
+
+needs_stemmer = pytest.mark.skipif(snowballstemmer is None, reason="snowballstemmer не установлен")
+
+
+def test_normalize_text_folds_case_yo_and_spaces():
+    assert normalize_text("  Ёлка   и\tЁЖИК ") == "елка и ежик"
+
+
+def test_substring_keyword_matches_word_forms():
+    matcher = KeywordMatcher(("нейросет",))
+
+    assert matcher.matches("Новые НЕЙРОСЕТИ научились рисовать")
+    assert matcher.matches("Обзор нейросетей")
+    assert not matcher.matches("Новости искусственного интеллекта")
+
+
+def test_quoted_keyword_is_matched_as_whole_phrase():
+    matcher = KeywordMatcher(('"ИИ"',))
+
+    assert matcher.matches("Регулирование ИИ в Европе")
+    assert not matcher.matches("Новости армии России")
+
+
+def test_whole_words_bounds_every_keyword():
+    matcher = KeywordMatcher(("кот",), whole_words=True)
+
+    assert matcher.matches("Кот, который гулял сам по себе")
+    assert not matcher.matches("Котировки акций выросли")
+
+
+def test_punctuation_keywords_still_match():
+    assert KeywordMatcher(("c++",)).matches("Вышел новый стандарт C++26")
+
+
+def test_find_sources_returns_keywords_as_given():
+    matcher = KeywordMatcher(("Python", '"машинное обучение"', "нейросет"))
+
+    found = matcher.find_sources("Машинное обучение на Python без нейросетей")
+
+    assert found == {"Python", '"машинное обучение"', "нейросет"}
+
+
+def test_overlapping_keywords_are_all_found():
+    matcher = KeywordMatcher(("he", "she", "hers"))
+
+    assert matcher.find_sources("ushers") == {"he", "she", "hers"}
+
+
+def test_empty_keywords_match_nothing():
+    matcher = KeywordMatcher(("", '""', "  "))
+
+    assert not matcher
+    assert not matcher.matches("любой текст")
+    assert matcher.find_sources("любой текст") == set()
+
+
+@needs_stemmer
+def test_stemming_matches_other_word_forms():
+    matcher = KeywordMatcher(("нейросети", "elections"), stem=True)
+
+    assert matcher.matches("Компания управляет нейросетями в облаке")
+    assert matcher.matches("The election results are in")
+    assert not KeywordMatcher(("нейросети",)).matches("обучение нейросетями")
+
+
+def test_compile_keywords_is_cached():
+    assert compile_keywords(("космос",)) is compile_keywords(("космос",))
+    assert compile_keywords(("космос",)) is not compile_keywords(("космос",), whole_words=True)
+
+
+def test_subscription_index_routes_to_matching_subscriptions():
+    index = SubscriptionIndex()
+    index.add((1, "технологии"), ["python", "нейросет"])
+    index.add((2, "технологии"), ["нейросет"])
+    index.add((3, "технологии"), [])
+    index.add((4, "технологии"), ["космос"])
+
+    assert index.route("Новая нейросеть на Python") == {(1, "технологии"), (2, "технологии"), (3, "технологии")}
+    assert index.route("Запуск к Марсу") == {(3, "технологии")}
+    assert index.scanned == 2
+    assert len(index) == 4
+
+
+def test_subscription_index_picks_up_added_subscriptions():
+    index = SubscriptionIndex(whole_words=True)
+    index.add("a", ["кот"])
+    assert index.route("Котировки") == set()
+
+    index.add("b", ["котировки"])
+    assert index.route("Котировки") == {"b"}
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import shutil
+
+from news_sources import LOCAL_FILTER_PAGE_SIZE, FeedParser, RssSource, merge_articles, plan_news_query
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+RSS_FEED = os.path.join(FIXTURES, 'feed.xml')
+ATOM_FEED = os.path.join(FIXTURES, 'atom.xml')
+
+
+def parse_file(path, chunk_size=64):
+    parser = FeedParser()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            parser.feed(chunk)
+    return parser.close()
+
+
+def test_rss_items_are_parsed_in_newsapi_format():
+    articles = parse_file(RSS_FEED)
+
+    assert len(articles) == 2
+    first = articles[0]
+    assert first['title'] == 'Нейросети научились писать код'
+    assert first['url'] == 'https://example.com/news/1?utm_source=rss'
+    assert first['publishedAt'] == '2025-01-06T07:00:00Z'
+    assert first['source'] == {'id': None, 'name': 'Тестовая лента'}
+
+
+def test_html_is_stripped_from_descriptions():
+    articles = parse_file(RSS_FEED)
+
+    assert articles[0]['description'] == 'Новая модель обошла людей & программистов'
+    assert articles[1]['description'] == 'Ожидается снег'
+
+
+def test_atom_entries_are_parsed():
+    articles = parse_file(ATOM_FEED)
+
+    assert articles == [{
+        'title': 'Нейросеть от другого издания',
+        'description': 'Краткое описание',
+        'url': 'https://example.com/news/1',
+        'publishedAt': '2025-01-06T12:00:00Z',
+        'source': {'id': None, 'name': 'Atom лента'}
+    }]
+
+
+def test_local_feed_is_filtered_by_query_and_date():
+    source = RssSource([RSS_FEED], http=None, stem=True)
+
+    articles = asyncio.run(source.fetch('нейросетями', 'ru', 'background'))
+    assert [article['url'] for article in articles] == ['https://example.com/news/1?utm_source=rss']
+
+    articles = asyncio.run(source.fetch('нейросети', 'ru', 'background', {'from': '2025-01-07T00:00:00Z'}))
+    assert articles == []
+
+
+def test_unchanged_local_feed_is_not_parsed_again(tmp_path):
+    path = str(tmp_path / 'feed.xml')
+    shutil.copy(RSS_FEED, path)
+    source = RssSource([path], http=None)
+
+    async def load_twice():
+        first = await source.load_feed(path)
+        second = await source.load_feed(path)
+        return first, second
+
+    first, second = asyncio.run(load_twice())
+    assert second is first
+    assert source.downloaded == 1
+    assert source.not_modified == 1
+
+    # Измененный файл разбирается заново
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    asyncio.run(source.load_feed(path))
+    assert source.downloaded == 2
+
+
+def test_merge_drops_duplicates_by_canonical_url_newest_first():
+    rss = parse_file(RSS_FEED)
+    atom = parse_file(ATOM_FEED)
+
+    merged = merge_articles(rss, atom)
+
+    assert [article['url'] for article in merged] == [
+        'https://example.com/news/1?utm_source=rss',
+        'https://example.com/news/2'
+    ]
+
+
+
+def test_topic_without_keywords_is_queried_as_is():
+    assert plan_news_query('искусственный интеллект') == {'q': 'искусственный интеллект'}
+
+
+def test_keywords_stay_local_with_a_larger_page_by_default():
+    # Подстроки и основы слов NewsAPI не находит - запрашиваем тему и больше статей для фильтра
+    assert plan_news_query('ии', ['нейросет']) == {'q': 'ии', 'pageSize': LOCAL_FILTER_PAGE_SIZE}
+    assert plan_news_query('ии', ['"машинное обучение"'], whole_words=True, stem=True) == {
+        'q': 'ии', 'pageSize': LOCAL_FILTER_PAGE_SIZE
+    }
+
+
+def test_whole_word_keywords_are_sent_upstream():
+    assert plan_news_query('ии', ['"машинное обучение"', 'нейросети', 'AND'], whole_words=True) == {
+        'q': 'ии AND ("машинное обучение" OR нейросети OR "AND")',
+        'searchIn': 'title,description'
+    }
+
+
+def test_keywords_over_the_length_limit_stay_local():
+    keywords = [f'слово{i}' for i in range(100)]
+    assert plan_news_query('ии', keywords, whole_words=True) == {'q': 'ии', 'pageSize': LOCAL_FILTER_PAGE_SIZE}
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+
+from ranking import ArticleRanker, parse_source_weights
+
+NOW = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+TOPIC = ("технологии", "ru", ())
+
+
+def article(title, hours_ago=1, source="РБК", description=""):
+    published = (NOW - timedelta(hours=hours_ago)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return {"title": title, "description": description, "publishedAt": published, "source": {"name": source}}
+
+
+def titles(articles):
+    return [item["title"] for item in articles]
+
+
+def test_parse_source_weights():
+    weights = parse_source_weights("РБК=1.2, Lenta.ru=0.8,bad=x,=3,")
+
+    assert weights == {"рбк": 1.2, "lenta.ru": 0.8}
+
+
+def test_relevant_article_ranks_first():
+    ranker = ArticleRanker(recency_weight=0)
+    news = {("космос", "ru", ("марс",)): [
+        article("Рынок акций закрылся в плюсе"),
+        article("Ровер на Марсе нашел следы воды", description="Космос и Марс"),
+        article("Запуск к Марсу перенесли"),
+    ]}
+
+    ranked = ranker.rank(news, now=NOW.timestamp())[("космос", "ru", ("марс",))]
+
+    assert titles(ranked) == ["Ровер на Марсе нашел следы воды", "Запуск к Марсу перенесли",
+                              "Рынок акций закрылся в плюсе"]
+
+
+def test_newer_article_wins_at_equal_relevance():
+    ranker = ArticleRanker(half_life_hours=24)
+    news = {TOPIC: [article("Старая новость", hours_ago=48), article("Свежая новость", hours_ago=1)]}
+
+    ranked = ranker.rank(news, now=NOW.timestamp())[TOPIC]
+
+    assert titles(ranked) == ["Свежая новость", "Старая новость"]
+
+
+def test_source_weight_lifts_article():
+    ranker = ArticleRanker(source_weights={"lenta.ru": 2.0})
+    news = {TOPIC: [article("Первая", source="РБК"), article("Вторая", source="Lenta.ru")]}
+
+    ranked = ranker.rank(news, now=NOW.timestamp())[TOPIC]
+
+    assert titles(ranked) == ["Вторая", "Первая"]
+
+
+def test_ties_keep_original_order():
+    ranker = ArticleRanker()
+    news = {TOPIC: [article("Первая"), article("Вторая"), {"title": "Без даты"}]}
+
+    ranked = ranker.rank(news, now=NOW.timestamp())[TOPIC]
+
+    assert titles(ranked)[:2] == ["Первая", "Вторая"]
+
+
+def test_article_shared_between_topics_is_ranked_per_topic():
+    shared = article("Нейросеть предсказала погоду в космосе")
+    news = {
+        ("космос", "ru", ()): [article("Нейросети в медицине"), shared],
+        ("нейросети", "ru", ()): [article("Запуск космического корабля"), shared],
+    }
+
+    ranked = ArticleRanker(recency_weight=0).rank(news, now=NOW.timestamp())
+
+    assert ranked[("космос", "ru", ())][0] is shared
+    assert ranked[("нейросети", "ru", ())][0] is shared
+
+
+def test_empty_topics_are_kept():
+    assert ArticleRanker().rank({TOPIC: []}) == {TOPIC: []}
@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+
+import pytest
+from zoneinfo import ZoneInfo
+
+from scheduler import DigestScheduler, get_timezone, parse_digest_time
+
+MOSCOW = ZoneInfo("Europe/Moscow")
+
+
+def timestamp(*args, tz=timezone.utc):
+    return datetime(*args, tzinfo=tz).timestamp()
+
+
+def test_parse_digest_time():
+    assert parse_digest_time(" 08:05 ") == (8, 5)
+    with pytest.raises(ValueError):
+        parse_digest_time("25:00")
+
+
+def test_get_timezone():
+    assert get_timezone("Europe/Moscow") == MOSCOW
+    assert get_timezone("Mars/Olympus") is None
+    assert get_timezone(None) is None
+
+
+def test_next_run_uses_user_time_and_timezone():
+    scheduler = DigestScheduler(default_time="09:00", default_timezone="UTC")
+    after = timestamp(2026, 3, 1, 4, 0)
+
+    # 08:30 по Москве - 05:30 UTC того же дня
+    assert scheduler.next_run(1, "08:30", "Europe/Moscow", after=after) == timestamp(2026, 3, 1, 5, 30)
+    assert scheduler.next_run(1, after=after) == timestamp(2026, 3, 1, 9, 0)
+
+
+def test_next_run_moves_to_tomorrow_when_time_has_passed():
+    scheduler = DigestScheduler(default_time="09:00", default_timezone="UTC")
+
+    assert scheduler.next_run(1, after=timestamp(2026, 3, 1, 9, 0)) == timestamp(2026, 3, 2, 9, 0)
+
+
+def test_invalid_user_time_falls_back_to_default():
+    scheduler = DigestScheduler(default_time="07:15", default_timezone="UTC")
+
+    assert scheduler.next_run(1, "утром", after=timestamp(2026, 3, 1)) == timestamp(2026, 3, 1, 7, 15)
+
+
+def test_spread_is_stable_and_only_for_default_time():
+    scheduler = DigestScheduler(default_time="09:00", default_timezone="UTC", spread_minutes=30)
+    after = timestamp(2026, 3, 1)
+    start = timestamp(2026, 3, 1, 9, 0)
+
+    runs = [scheduler.next_run(user_id, after=after) for user_id in range(50)]
+
+    assert all(start <= run_at < start + 30 * 60 for run_at in runs)
+    assert len(set(runs)) > 1
+    assert runs == [scheduler.next_run(user_id, after=after) for user_id in range(50)]
+    assert scheduler.next_run(7, "09:00", after=after) == start
+
+
+def test_pop_due_returns_users_in_time_order_with_limit():
+    scheduler = DigestScheduler(default_timezone="UTC")
+    after = timestamp(2026, 3, 1)
+    scheduler.schedule(1, "09:30", after=after)
+    scheduler.schedule(2, "09:10", after=after)
+    scheduler.schedule(3, "09:20", after=after)
+    scheduler.schedule(4, "12:00", after=after)
+
+    assert scheduler.pop_due(now=timestamp(2026, 3, 1, 8, 0)) == []
+    assert scheduler.pop_due(now=timestamp(2026, 3, 1, 10, 0), limit=2) == [2, 3]
+    assert scheduler.pop_due(now=timestamp(2026, 3, 1, 10, 0)) == [1]
+    assert len(scheduler) == 1
+
+
+def test_rescheduled_and_cancelled_users_are_not_popped_twice():
+    scheduler = DigestScheduler(default_timezone="UTC")
+    after = timestamp(2026, 3, 1)
+    scheduler.schedule(1, "09:00", after=after)
+    scheduler.schedule(1, "11:00", after=after)
+    scheduler.schedule(2, "09:00", after=after)
+    scheduler.cancel(2)
+
+    assert scheduler.pop_due(now=timestamp(2026, 3, 1, 10, 0)) == []
+    assert scheduler.scheduled_at(1) == timestamp(2026, 3, 1, 11, 0)
+    assert scheduler.pop_due(now=timestamp(2026, 3, 1, 11, 0)) == [1]
+    assert scheduler.scheduled_at(2) is None
+
+
+def test_heap_is_compacted_after_many_reschedules():
+    scheduler = DigestScheduler(default_timezone="UTC")
+    after = timestamp(2026, 3, 1)
+    for _ in range(200):
+        scheduler.schedule(1, "09:00", after=after)
+
+    assert len(scheduler._heap) <= 2 * len(scheduler) + 65
+
+
+def test_due_within():
+    scheduler = DigestScheduler(default_timezone="UTC")
+    after = timestamp(2026, 3, 1)
+    scheduler.schedule(1, "09:05", after=after)
+    scheduler.schedule(2, "09:30", after=after)
+
+    assert scheduler.due_within(600, now=timestamp(2026, 3, 1, 9, 0)) == [1]
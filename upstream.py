@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Асинхронный HTTP клиент для внешних API (NewsAPI, Open-Meteo)
+Общий пул соединений с keep-alive, ограничение параллельных запросов к каждому хосту,
+автоматические выключатели (circuit breaker) и дублирующие запросы на медленных ответах
+"""
+
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """Ошибка при обращении к внешнему API"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class QuotaExceededError(UpstreamError):
+    """Квота запросов к API исчерпана, запрос не выполнялся"""
+
+
+class CircuitOpenError(UpstreamError):
+    """Выключатель хоста разомкнут, запрос не выполнялся"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (в секундах)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def is_upstream_failure(error: UpstreamError) -> bool:
+    """Считается ли ошибка отказом сервиса (сеть, таймаут, 5xx), а не ошибкой запроса"""
+    return error.status_code is None or error.status_code >= 500
+
+
+class CircuitBreaker:
+    """Выключатель: после серии отказов запросы к хосту сразу отклоняются, затем пропускается пробный"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started = 0.0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow_request(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            # В полуоткрытом состоянии пропускаем один пробный запрос;
+            # проба без результата (например, отмененная) перестает блокировать через reset_timeout
+            now = time.monotonic()
+            if not self.probe_in_flight or now - self.probe_started >= self.reset_timeout:
+                self.probe_in_flight = True
+                self.probe_started = now
+                return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        """Успешный ответ замыкает выключатель"""
+        if self.state != self.CLOSED:
+            logger.info(f"Выключатель {self.name} замкнут: сервис снова отвечает")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Отказ; после failure_threshold подряд (или неудачной пробы) выключатель размыкается"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logger.warning(f"Выключатель {self.name} разомкнут на {self.reset_timeout:.0f} сек после {self.failures} отказов")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def stats(self) -> Dict:
+        """Состояние и счетчики выключателя"""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'trips': self.trips
+        }
+
+
+class UpstreamClient:
+    """Общий асинхронный HTTP клиент с пулом соединений"""
+
+    def __init__(self, timeout: float = 10.0, max_connections: int = 100,
+                 max_keepalive: int = 20, per_host_limit: int = 10,
+                 breaker_failures: int = 5, breaker_reset: float = 30,
+                 hedge_after: float = 0, hedge_hosts: Iterable[str] = ()):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.per_host_limit = per_host_limit
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        # Через сколько секунд без ответа отправлять дублирующий запрос (0 - не отправлять)
+        self.hedge_after = hedge_after
+        # Хосты без платной квоты, к которым можно дублировать запросы (каждый дубль NewsAPI расходует квоту)
+        self.hedge_hosts = frozenset(host.lower() for host in hedge_hosts)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Создает клиент при первом обращении (внутри работающего event loop)"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=30.0
+                ),
+                headers={'User-Agent': 'telegram-news-bot'},
+                follow_redirects=True
+            )
+        return self._client
+
+    def _get_semaphore(self, host: str) -> asyncio.Semaphore:
+        """Ограничитель параллельных запросов к хосту"""
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    def get_breaker(self, host: str) -> CircuitBreaker:
+        """Выключатель для хоста"""
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, self.breaker_failures, self.breaker_reset)
+            self._breakers[host] = breaker
+        return breaker
+
+    def _check_breaker(self, host: str) -> CircuitBreaker:
+        """Возвращает выключатель хоста или сразу отклоняет запрос, если он разомкнут"""
+        breaker = self.get_breaker(host)
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"{host} временно недоступен (выключатель разомкнут)")
+        return breaker
+
+    @staticmethod
+    def _raise_for_status(host: str, response: httpx.Response) -> None:
+        """Превращает коды 4xx/5xx в UpstreamError"""
+        if response.status_code >= 400:
+            raise UpstreamError(
+                f"{host} вернул HTTP {response.status_code}",
+                status_code=response.status_code,
+                retry_after=parse_retry_after(response.headers.get('Retry-After'))
+            )
+
+    async def _send(self, host: str, url: str, params: Optional[Dict],
+                    headers: Optional[Dict]) -> httpx.Response:
+        """Один GET запрос с переводом ошибок httpx в UpstreamError"""
+        try:
+            response = await self._get_client().get(url, params=params, headers=headers)
+        except httpx.TimeoutException as e:
+            raise UpstreamError(f"Превышено время ожидания ответа от {host}: {e!r}") from e
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"Ошибка соединения с {host}: {e!r}") from e
+        self._raise_for_status(host, response)
+        return response
+
+    async def _send_hedged(self, host: str, url: str, params: Optional[Dict],
+                           headers: Optional[Dict]) -> httpx.Response:
+        """Если ответа нет дольше hedge_after, отправляет второй запрос и берет первый успешный"""
+        first = asyncio.ensure_future(self._send(host, url, params, headers))
+        pending = {first}
+        error: Optional[BaseException] = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done:
+                return first.result()
+
+            self.hedged += 1
+            second = asyncio.ensure_future(self._send(host, url, params, headers))
+            pending.add(second)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get(self, url: str, params: Optional[Dict] = None,
+                  headers: Optional[Dict] = None) -> httpx.Response:
+        """Выполняет GET запрос; сетевые ошибки и коды 4xx/5xx превращаются в UpstreamError"""
+        host = httpx.URL(url).host
+        breaker = self._check_breaker(host)
+        async with self._get_semaphore(host):
+            try:
+                if self.hedge_after > 0 and host in self.hedge_hosts:
+                    response = await self._send_hedged(host, url, params, headers)
+                else:
+                    response = await self._send(host, url, params, headers)
+            except UpstreamError as e:
+                if is_upstream_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+        breaker.record_success()
+        return response
+
+    @asynccontextmanager
+    async def stream(self, url: str, params: Optional[Dict] = None,
+                     headers: Optional[Dict] = None) -> AsyncIterator[httpx.Response]:
+        """GET запрос с потоковым чтением тела ответа (ошибки как в get, без дублирования)"""
+        host = httpx.URL(url).host
+        breaker = self._check_breaker(host)
+        async with self._get_semaphore(host):
+            try:
+                async with self._get_client().stream('GET', url, params=params, headers=headers) as response:
+                    self._raise_for_status(host, response)
+                    yield response
+            except httpx.TimeoutException as e:
+                breaker.record_failure()
+                raise UpstreamError(f"Превышено время ожидания ответа от {host}: {e!r}") from e
+            except httpx.HTTPError as e:
+                breaker.record_failure()
+                raise UpstreamError(f"Ошибка соединения с {host}: {e!r}") from e
+            except UpstreamError as e:
+                if is_upstream_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+        breaker.record_success()
+
+    async def get_json(self, url: str, params: Optional[Dict] = None) -> Dict:
+        """Выполняет GET запрос и возвращает разобранный JSON"""
+        response = await self.get(url, params=params)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise UpstreamError(f"Некорректный JSON от {httpx.URL(url).host}: {e}") from e
+
+    def stats(self) -> Dict:
+        """Состояние выключателей и счетчики дублирующих запросов"""
+        return {
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'breakers': {host: breaker.stats() for host, breaker in self._breakers.items()}
+        }
+
+    async def aclose(self) -> None:
+        """Закрывает пул соединений"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None